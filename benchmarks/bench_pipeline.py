@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 20:30
+# @Last Modified by: wqshen
+
+"""End-to-end benchmark of the forecast pipeline without the real model weights and D1D data
+
+Stand-in ONNX models with the input/output signature of the Pangu models (input 5x13x721x1440,
+input_surface 4x721x1440, a single Mul each) are generated for every step model, together with a
+synthetic D1D GRIB file (bz2) converted by `d1d_to_pangu.run`, or a synthetic input NetCDF when
+`--no-convert` is given or eccodes is not available. `run_model` runs the schedule of each lead time
+set, stage timings come from the Timer metrics and peak RSS from /proc. One json line per lead time
+set is appended to the results file (in the temporary directory unless `--results` is given), so
+runs of different revisions are easy to compare.
+
+Example:
+    python benchmarks/bench_pipeline.py --lead-times 1-12 24-240/24 --results results.jsonl
+    python benchmarks/bench_pipeline.py --lead-times 1-6 --output-format zarr --compression lz4
+"""
+
+import os
+import sys
+import bz2
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import xarray as xr
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pangu'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from logzero import logger, loglevel  # noqa: E402
+from timer import Timer  # noqa: E402
+from session_config import SessionConfig, PROVIDERS  # noqa: E402
+from planner import plan_forecast, parse_lead_times, ORDERS, STEP_LIST  # noqa: E402
+from writer import OUTPUT_FORMATS, COMPRESSIONS, LEVELS  # noqa: E402
+from pangu import run_model  # noqa: E402
+from bench_write import synthetic_output  # noqa: E402
+
+
+def make_model(path, scale=1.0001):
+    """Stand-in model with the signature of the Pangu models, multiplying both inputs by `scale`"""
+    import onnx
+    from onnx import helper, TensorProto
+
+    upper, surface = [5, 13, 721, 1440], [4, 721, 1440]
+    graph = helper.make_graph(
+        [helper.make_node('Mul', ['input', 'scale'], ['output']),
+         helper.make_node('Mul', ['input_surface', 'scale'], ['output_surface'])],
+        'pangu_stand_in',
+        [helper.make_tensor_value_info('input', TensorProto.FLOAT, upper),
+         helper.make_tensor_value_info('input_surface', TensorProto.FLOAT, surface)],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, upper),
+         helper.make_tensor_value_info('output_surface', TensorProto.FLOAT, surface)],
+        [helper.make_tensor('scale', TensorProto.FLOAT, [], [scale])])
+    # pinned, so the model loads with onnxruntime releases older than the installed onnx
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=7)
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+
+def write_input_netcdf(path, seed=0):
+    """Synthetic input file in the layout written by `d1d_to_pangu.run`"""
+    output, output_surface = synthetic_output(seed)
+    coords = {'isobaricInhPa': LEVELS, 'latitude': np.linspace(90, -90, 721, dtype='f4'),
+              'longitude': np.linspace(0, 359.75, 1440, dtype='f4')}
+    data_vars = {name: (('isobaricInhPa', 'latitude', 'longitude'), d)
+                 for name, d in zip(('z', 'q', 't', 'u', 'v'), output)}
+    data_vars.update({name: (('latitude', 'longitude'), d)
+                      for name, d in zip(('msl', 'u10', 'v10', 't2m'), output_surface)})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    xr.Dataset(data_vars, coords=coords).to_netcdf(path)
+
+
+def write_d1d_grib(path, inittime, resolution=0.25, seed=0):
+    """Synthetic bz2 compressed D1D GRIB file with the messages read by `d1d_to_pangu.run`"""
+    import eccodes
+
+    output, output_surface = synthetic_output(seed)
+    step = int(round(resolution / 0.25))
+    output, output_surface = output[..., ::step, ::step], output_surface[..., ::step, ::step]
+    nj, ni = output_surface.shape[-2:]
+    fields = [(name, 'isobaricInhPa', int(level), d / 9.80665 if name == 'gh' else d)
+              for name, upper in zip(('gh', 'q', 't', 'u', 'v'), output) for level, d in zip(LEVELS, upper)]
+    fields += [('msl', 'surface', 0, output_surface[0]), ('10u', 'surface', 0, output_surface[1]),
+               ('10v', 'surface', 0, output_surface[2]), ('2t', 'surface', 0, output_surface[3]),
+               ('100u', 'surface', 0, output_surface[1] * 1.2), ('100v', 'surface', 0, output_surface[2] * 1.2)]
+    tmp = f'{path}.grib'
+    with open(tmp, 'wb') as f:
+        for name, level_type, level, d in fields:
+            sample = 'regular_ll_pl_grib1' if level_type == 'isobaricInhPa' else 'regular_ll_sfc_grib1'
+            gid = eccodes.codes_grib_new_from_samples(sample)
+            try:
+                for key, value in (('dataDate', int(f'{inittime:%Y%m%d}')), ('dataTime', inittime.hour * 100),
+                                   ('Ni', ni), ('Nj', nj),
+                                   ('latitudeOfFirstGridPointInDegrees', 90.),
+                                   ('longitudeOfFirstGridPointInDegrees', 0.),
+                                   ('latitudeOfLastGridPointInDegrees', -90.),
+                                   ('longitudeOfLastGridPointInDegrees', 360. - resolution),
+                                   ('iDirectionIncrementInDegrees', resolution),
+                                   ('jDirectionIncrementInDegrees', resolution),
+                                   ('shortName', name), ('bitsPerValue', 16)):
+                    eccodes.codes_set(gid, key, value)
+                if level_type == 'isobaricInhPa':
+                    eccodes.codes_set(gid, 'level', level)
+                eccodes.codes_set_values(gid, d.astype('f8').ravel())
+                eccodes.codes_write(gid, f)
+            finally:
+                eccodes.codes_release(gid)
+    with open(tmp, 'rb') as src, bz2.open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 2 ** 24)
+    os.remove(tmp)
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process (Linux), so that the peak of each stage is measured"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak RSS (MB) of the process since the last `reset_peak_rss`"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_convert(inittime, work_dir, resolution):
+    """Time `d1d_to_pangu.run` on a synthetic D1D file, None if eccodes or cfgrib is not available"""
+    try:
+        import eccodes  # noqa: F401
+        import cfgrib  # noqa: F401
+    except ImportError as e:
+        logger.warning(f"converter is not benchmarked: {e}")
+        return None
+    from d1d_to_pangu import run as d1d_to_pangu
+
+    d1d_dir = f'{work_dir}/d1d'
+    path = f'{d1d_dir}/{inittime:%Y%m%d/%H}/W_NAFP_C_ECMF_{inittime:%Y%m%d%H%M%S}_P_D1D' \
+           f'{inittime:%m%d%H%M}{inittime:%m%d%H}011.bz2'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_d1d_grib(path, inittime, resolution)
+    reset_peak_rss()
+    timer = Timer(name='d1d_to_pangu', logger=None)
+    timer.start()
+    d1d_to_pangu(inittime, d1d_dir, f'{work_dir}/input')
+    return {'seconds': timer.stop(), 'peak_rss_mb': peak_rss()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the forecast pipeline',
+                                     epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lead-times', nargs='+', type=str, default=['1-12', '24-240/24'],
+                        help='lead time sets benchmarked one after another, e.g. 1-84 87-360/3')
+    parser.add_argument('--step-models', type=lambda s: tuple(int(h) for h in s.split(',')), default=STEP_LIST,
+                        help='hour steps of the stand-in models')
+    parser.add_argument('--order', type=str, choices=ORDERS, default='by-model', help='execution order of the steps')
+    parser.add_argument('--provider', type=str, choices=PROVIDERS, default='cpu', help='execution provider')
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default='netcdf')
+    parser.add_argument('--compression', type=str, choices=COMPRESSIONS, default='none')
+    parser.add_argument('--writer-workers', type=int, default=1, help='number of background writer threads')
+    parser.add_argument('--no-convert', action='store_true',
+                        help='write a synthetic input NetCDF instead of converting a synthetic D1D GRIB file')
+    parser.add_argument('--grib-resolution', type=float, default=0.25, help='grid spacing of the synthetic D1D file')
+    parser.add_argument('--results', type=str,
+                        default=os.path.join(tempfile.gettempdir(), 'pangu_bench_pipeline.jsonl'),
+                        help='json lines file the results are appended to, in the temporary directory by default')
+    parser.add_argument('--work-dir', type=str, default=None, help='directory of generated files, temporary by default')
+    parser.add_argument('-o', '--loglevel', type=int, default=30, help='loglevel: 10, 20, 30, 40, 50')
+    args = parser.parse_args()
+    loglevel(args.loglevel)
+
+    inittime = datetime(2023, 10, 1, 0)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pangu_bench_pipeline_')
+    model_path, input_dir = f'{work_dir}/models', f'{work_dir}/input'
+    session_config = SessionConfig.cpu() if args.provider == 'cpu' else SessionConfig()
+    try:
+        os.makedirs(model_path, exist_ok=True)
+        for hour_step in args.step_models:
+            make_model(f'{model_path}/pangu_weather_{hour_step}.onnx')
+
+        convert = None if args.no_convert else bench_convert(inittime, work_dir, args.grib_resolution)
+        if convert is None:
+            write_input_netcdf(f'{input_dir}/{inittime:%Y%m%d%H}/pangu_input.ecmwf_d1d.{inittime:%Y%m%d%H}.nc')
+
+        print(f"{'lead times':>16} {'steps':>6} {'total (s)':>10} {'infer p50':>10} {'load p50':>10} "
+              f"{'write p50':>10} {'peak RSS (MB)':>14}")
+        for text in args.lead_times:
+            plan = plan_forecast(parse_lead_times(text), args.step_models, args.order)
+            output_dir, metrics_dir = f'{work_dir}/output', f'{work_dir}/metrics'
+            shutil.rmtree(output_dir, ignore_errors=True)
+            reset_peak_rss()
+            timer = Timer(name='bench_run_model', logger=None)
+            timer.start()
+            run_model(inittime, input_dir, output_dir, model_path, plan=plan, session_config=session_config,
+                      output_format=args.output_format, compression=args.compression,
+                      writer_workers=args.writer_workers, metrics_dir=metrics_dir)
+            elapsed = timer.stop()
+            with open(f'{metrics_dir}/pangu.I{inittime:%Y%m%d%H}.metrics.json') as f:
+                stages = json.load(f)['totals']
+            result = {'time': f'{datetime.now():%Y-%m-%d %H:%M:%S}', 'revision': git_revision(),
+                      'lead_times': text, 'steps': len(plan), 'order': args.order, 'provider': args.provider,
+                      'output_format': args.output_format, 'compression': args.compression,
+                      'writer_workers': args.writer_workers, 'seconds': elapsed, 'peak_rss_mb': peak_rss(),
+                      'stages': stages, 'convert': convert}
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+            def p50(name):
+                return stages.get(name, {}).get('p50') or float('nan')
+
+            print(f"{text:>16} {len(plan):>6} {elapsed:>10.2f} {p50('pangu_inference'):>10.3f} "
+                  f"{p50('load_pangu_input'):>10.3f} {p50('write_netcdf4'):>10.3f} {result['peak_rss_mb']:>14.0f}")
+        if convert is not None:
+            print(f"d1d_to_pangu: {convert['seconds']:.2f} s, peak RSS {convert['peak_rss_mb']:.0f} MB")
+        print(f"results appended to {args.results}")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
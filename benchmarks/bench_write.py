@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 11:20
+# @Last Modified by: wqshen
+
+"""Benchmark write time and file size of the forecast output formats and compressions
+
+netcdf and zarr are written through xarray by `pangu.write`, netcdf-writer by the `writer.NetCDFWriter`
+that `pangu.run_model` uses for NetCDF outputs when netCDF4 is installed.
+
+Example:
+    python benchmarks/bench_write.py --repeat 3 --combination netcdf-writer:none zarr:lz4 zarr:zstd
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pangu'))
+
+from pangu import write, output_path  # noqa: E402
+from writer import NetCDFWriter  # noqa: E402
+
+
+def synthetic_output(seed=0):
+    """Smooth fields with small scale noise, compress roughly like the real forecast"""
+    rng = np.random.default_rng(seed)
+    lat = np.linspace(90, -90, 721, dtype='f4')[:, None]
+    lon = np.linspace(0, 359.75, 1440, dtype='f4')[None, :]
+    pattern = np.cos(np.deg2rad(lat)) * (1 + 0.1 * np.sin(np.deg2rad(3 * lon)))
+
+    def field(mean, amplitude, noise):
+        return (mean + amplitude * pattern + noise * rng.standard_normal((721, 1440))).astype('f4')
+
+    level = np.array([1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50])
+    height = 44330 * (1 - (level / 1013.25) ** 0.1903)
+    output = np.stack([
+        np.stack([field(9.80665 * h, 2000, 50) for h in height]),
+        np.stack([field(0.01 * (p / 1000) ** 3, 0.005, 1e-4) for p in level]),
+        np.stack([field(288 - 0.0065 * min(h, 11000), 20, 0.5) for h in height]),
+        np.stack([field(5, 15, 2) for _ in level]),
+        np.stack([field(0, 10, 2) for _ in level]),
+    ])
+    output_surface = np.stack([field(101325, 1500, 100), field(0, 5, 1), field(0, 5, 1), field(260, 40, 1)])
+    return output, output_surface
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of forecast output writing')
+    parser.add_argument('--combination', nargs='+', type=str,
+                        default=['netcdf:none', 'netcdf:zlib', 'netcdf-writer:none', 'netcdf-writer:zlib',
+                                 'zarr:none', 'zarr:zlib', 'zarr:lz4', 'zarr:zstd'],
+                        help='format:compression to be benchmarked, format netcdf-writer is the NetCDFWriter')
+    parser.add_argument('--complevel', type=int, default=1, help='compression level')
+    parser.add_argument('--repeat', type=int, default=3, help='number of writes per combination')
+    parser.add_argument('--output-dir', type=str, default=None, help='directory of written files, temporary by default')
+    args = parser.parse_args()
+
+    output, output_surface = synthetic_output()
+    inittime = datetime(2023, 10, 1, 0)
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='pangu_bench_write_')
+    baseline = None
+    print(f"{'format':>13} {'compression':>12} {'time (s)':>10} {'size (MB)':>10} {'ratio':>7} {'speedup':>8}")
+    try:
+        for combination in args.combination:
+            output_format, compression = combination.split(':')
+            if output_format == 'netcdf-writer':
+                # built once per run by run_model, not timed
+                writer = NetCDFWriter(output_dir, compression, args.complevel)
+            elapsed = []
+            for fh in range(1, args.repeat + 1):
+                start = time.perf_counter()
+                if output_format == 'netcdf-writer':
+                    writer.write(inittime, fh, output, output_surface)
+                else:
+                    write(inittime, fh, output, output_surface, output_dir, output_format, compression,
+                          args.complevel)
+                elapsed.append(time.perf_counter() - start)
+            path_format = 'netcdf' if output_format == 'netcdf-writer' else output_format
+            size = path_size(output_path(inittime, 1, output_dir, path_format))
+            t = float(np.median(elapsed))
+            if baseline is None:
+                baseline = (t, size)
+            print(f"{output_format:>13} {compression:>12} {t:>10.3f} {size / 2 ** 20:>10.1f} "
+                  f"{baseline[1] / size:>7.2f} {baseline[0] / t:>8.2f}")
+            shutil.rmtree(f'{output_dir}/{inittime:%Y%m%d%H}')
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
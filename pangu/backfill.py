@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 15:30
+# @Last Modified by: wqshen
+
+
+import os
+import time
+import multiprocessing as mp
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from logzero import logger
+from pangu import run_model, load_sessions, job_memory
+from planner import STEP_LIST
+
+
+_worker = {}
+
+
+def core_groups(workers, cores_per_worker=None, cores=None):
+    """Split the available cores into a group per worker"""
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    cores_per_worker = cores_per_worker or max(len(cores) // workers, 1)
+    groups = [cores[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(workers)]
+    return [g for g in groups if g]
+
+
+def model_memory(model_path, step_list=STEP_LIST):
+    """Estimated memory (bytes) of the sessions of all step models, the size of the onnx files"""
+    paths = [f'{model_path}/pangu_weather_{hour_step}.onnx' for hour_step in step_list]
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def _init_worker(groups, input_dir, output_dir, model_path, session_config, model_cache, run_kwargs):
+    try:
+        cores = groups.get(timeout=60)
+        os.sched_setaffinity(0, cores)
+    except Empty:
+        # never blocks a worker, all groups are taken only if workers are more than the groups
+        cores = sorted(os.sched_getaffinity(0))
+    if session_config is not None:
+        session_config = session_config.update(intra_op_num_threads=len(cores))
+    logger.info(f"backfill worker {os.getpid()} pinned to cores {cores}")
+    plan = run_kwargs.get('plan')
+    sessions = load_sessions(model_path, session_config, model_cache,
+                             plan.step_list if plan is not None else STEP_LIST)
+    _worker.update(input_dir=input_dir, output_dir=output_dir, model_path=model_path, run_kwargs=run_kwargs,
+                   sessions=sessions)
+
+
+def _run_worker(inittime):
+    start = time.perf_counter()
+    try:
+        run_model(inittime, _worker['input_dir'], _worker['output_dir'], _worker['model_path'],
+                  sessions=_worker['sessions'], **_worker['run_kwargs'])
+    except Exception as e:
+        logger.exception(e)
+        return inittime, f'{type(e).__name__}: {e}', time.perf_counter() - start
+    return inittime, None, time.perf_counter() - start
+
+
+def backfill(inittimes, input_dir, output_dir, model_path, workers=2, cores_per_worker=None, memory_cap=None,
+             session_config=None, model_cache=None, **run_kwargs):
+    """Run forecasts of many initial times across a pool of worker processes
+
+    Every worker is pinned to its own group of cores, loads the sessions of all step models once with
+    as many operator threads as its cores, and runs the initial times it gets one after another.
+    The number of workers is reduced to fit the estimated memory in `memory_cap` (bytes).
+    A failed initial time is logged and reported without stopping the others. If a worker dies
+    (e.g. killed by the OOM killer), the pool is broken and the remaining initial times are reported
+    as failed instead of waiting forever.
+
+    Returns
+    -------
+    (dict), error message of the failed initial times
+    """
+    if memory_cap is not None:
+        plan = run_kwargs.get('plan')
+        per_worker = model_memory(model_path, plan.step_list if plan is not None else STEP_LIST) + \
+            job_memory(**run_kwargs)
+        workers = max(1, min(workers, int(memory_cap // per_worker)))
+    groups = core_groups(workers, cores_per_worker)
+    workers = min(workers, len(groups), len(inittimes))
+    logger.info(f"backfill {len(inittimes)} initial times with {workers} workers")
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    for g in groups[:workers]:
+        queue.put(g)
+    failures = {}
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(queue, input_dir, output_dir, model_path, session_config, model_cache,
+                                       run_kwargs)) as executor:
+        futures = {executor.submit(_run_worker, it): it for it in inittimes}
+        for i, future in enumerate(as_completed(futures), 1):
+            try:
+                it, error, elapsed = future.result()
+            except BrokenProcessPool as e:
+                it = futures[future]
+                failures[it] = f'{type(e).__name__}: {e}'
+                logger.error(f"[{i}/{len(inittimes)}] {it:%Y%m%d%H} failed, a worker died: {e}")
+                continue
+            if error is not None:
+                failures[it] = error
+                logger.error(f"[{i}/{len(inittimes)}] {it:%Y%m%d%H} failed in {elapsed:0.1f} seconds: {error}")
+            else:
+                logger.info(f"[{i}/{len(inittimes)}] {it:%Y%m%d%H} finished in {elapsed:0.1f} seconds")
+    logger.info(f"backfill finished, {len(inittimes) - len(failures)} succeeded, {len(failures)} failed")
+    return failures
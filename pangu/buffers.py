@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 21:10
+# @Last Modified by: wqshen
+
+
+import threading
+import numpy as np
+from logzero import logger
+
+
+UPPER_SHAPE = (5, 13, 721, 1440)
+SURFACE_SHAPE = (4, 721, 1440)
+
+
+class BufferPool:
+    """Reference counted pool of preallocated state buffers (upper-air and surface float32 arrays)
+
+    A step writes its output into an acquired buffer, which is then shared without copies by the
+    state store, the writer and the next steps reading it as input. Every holder takes a reference
+    with `retain` and drops it with `release`, a buffer without references goes back to the pool and
+    is reused by a later step. Buffers are looked up by their upper-air array, arrays which do not
+    come from the pool (e.g. states read from disk) are ignored. The pool grows when all buffers are
+    in use, so it settles at the number of states alive at the same time and later steps allocate nothing.
+
+    Parameters
+    ----------
+    size: int, number of buffers allocated up front
+    """
+
+    def __init__(self, size=0):
+        self._lock = threading.Lock()
+        self._free = [self._allocate() for _ in range(size)]
+        self._refs = {}
+        self._buffers = {}
+        self.allocated = size
+
+    @staticmethod
+    def _allocate():
+        return np.empty(UPPER_SHAPE, dtype='f4'), np.empty(SURFACE_SHAPE, dtype='f4')
+
+    def acquire(self):
+        """A free buffer (upper, surface) with one reference held by the caller"""
+        with self._lock:
+            if self._free:
+                upper, surface = self._free.pop()
+            else:
+                upper, surface = self._allocate()
+                self.allocated += 1
+                logger.debug(f"buffer pool grows to {self.allocated} buffers")
+            self._refs[id(upper)] = 1
+            self._buffers[id(upper)] = (upper, surface)
+        return upper, surface
+
+    def retain(self, upper):
+        """Take a reference to the buffer of `upper`"""
+        with self._lock:
+            if id(upper) in self._refs:
+                self._refs[id(upper)] += 1
+
+    def release(self, upper):
+        """Drop a reference to the buffer of `upper`, it is reused once no reference is left"""
+        with self._lock:
+            key = id(upper)
+            if key not in self._refs:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                del self._refs[key]
+                self._free.append(self._buffers.pop(key))
+
+    def __len__(self):
+        """Number of buffers in use"""
+        return len(self._refs)
+
+
+class BoundSession:
+    """Run an inference session with IOBinding, the outputs are written into buffers of a BufferPool
+
+    Inputs are bound to the memory of the given arrays and outputs to the acquired buffer, so that
+    ONNX Runtime neither copies the inputs into new tensors nor allocates the outputs.
+
+    Examples
+    --------
+        >>>bound = BoundSession(session, pool)
+        >>>output, output_surface = bound.run(input, input_surface)  # a buffer of pool, to be released
+    """
+
+    def __init__(self, session, pool):
+        self.session = session
+        self.pool = pool
+        self.input_names = [i.name for i in session.get_inputs()]
+        self.output_names = [o.name for o in session.get_outputs()]
+
+    def run(self, input, input_surface):
+        output, output_surface = self.pool.acquire()
+        binding = self.session.io_binding()
+        for name, d in zip(self.input_names, (input, input_surface)):
+            binding.bind_cpu_input(name, np.ascontiguousarray(d, dtype='f4'))
+        for name, d in zip(self.output_names, (output, output_surface)):
+            binding.bind_output(name, 'cpu', 0, np.float32, list(d.shape), d.ctypes.data)
+        try:
+            self.session.run_with_iobinding(binding)
+        except Exception:
+            self.pool.release(output)
+            raise
+        return output, output_surface
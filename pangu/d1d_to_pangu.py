@@ -6,14 +6,25 @@
 
 
 import os
+import re
 import sys
+import bz2
+import mmap
+import shutil
 import argparse
+import tempfile
+import subprocess
 import numpy as np
 import xarray as xr
 from logzero import logger, loglevel
 from datetime import time, datetime, timedelta
 from glob import glob
-from bz2 import BZ2File
+from collections import deque
+from multiprocessing import Pool
+from grib import GribIndex, UPPER_NAMES, SURFACE_NAMES
+from reader import write_raw, SURFACE_VARS as INPUT_SURFACE_VARS
+from regrid import Regridder, TARGET_LATS, TARGET_LONS
+from writer import LEVELS
 
 
 def infer_inittime():
@@ -27,29 +38,101 @@ def infer_inittime():
         return now.replace(hour=0, minute=0) - timedelta(days=1)
 
 
-def run(it, input_dir, output_dir='/data/pangu/input/D1D'):
-    bzpath_wcard = f'{input_dir}/{it:%Y%m%d/%H}/W_NAFP_C_ECMF_*_P_D1D{it:%m%d%H%M}{it:%m%d%H}011.bz2'
-    bzpath = glob(bzpath_wcard)[0]
-    with BZ2File(bzpath) as bz2_file:
-        last_modified = datetime.fromtimestamp(os.path.getmtime(bzpath))
-        filename = os.path.splitext(os.path.basename(bzpath))[0]
-        path = os.path.join(output_dir, filename)
-        logger.info(f"decompress {os.path.basename(bzpath)} to {path}")
-        if os.path.isfile(path) and (datetime.fromtimestamp(os.path.getmtime(path)) >= last_modified):
-            logger.info(f"tempfile {bzpath} has existed, skip uncompress.")
-        else:
-            data = bz2_file.read()
-            open(path, "wb").write(data)
-            del data
-
-    target_lats = np.linspace(90, -90, 721, dtype='f4')
-    target_lons = np.linspace(0, 359.75, 1440, dtype='f4')
+# header of a bzip2 stream: magic, block size and the magic of its first block
+BZ2_STREAM_HEADER = re.compile(rb'BZh[1-9]1AY&SY')
+
+
+def bz2_streams(path):
+    """Byte ranges of the concatenated bzip2 streams of a file, e.g. written by pbzip2 or lbzip2"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        starts = [match.start() for match in BZ2_STREAM_HEADER.finditer(m)]
+        size = len(m)
+    if not starts or starts[0] != 0:
+        return [(0, size)]
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _decompress_range(args):
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
+
+
+def _decompress_streams(bzpath, path, ranges, workers):
+    """Decompress the streams of `ranges` by a process pool, False if a range is not a valid stream"""
+    workers = min(workers, len(ranges))
+    try:
+        # streams are decompressed ahead by the pool and written in order, at most 2 per worker are
+        # held in memory when the disk is slower than the decompression
+        with open(path, 'wb') as dst, Pool(workers) as pool:
+            pending = deque()
+            for start, end in ranges:
+                if len(pending) >= 2 * workers:
+                    dst.write(pending.popleft().get())
+                pending.append(pool.apply_async(_decompress_range, ((bzpath, start, end),)))
+            while pending:
+                dst.write(pending.popleft().get())
+    except (OSError, EOFError, ValueError) as e:
+        # a stream header found inside compressed data
+        logger.warning(f"failed to split {os.path.basename(bzpath)} into bzip2 streams: {e}")
+        return False
+    return True
+
+
+def decompress(bzpath, path, workers=1, chunk_size=2 ** 24):
+    """Decompress a bz2 file into `path` without holding it in memory
+
+    The data are streamed in chunks of `chunk_size` bytes into a temporary file renamed to `path`
+    when it is complete, so a file under the final name is never partial. With `workers` > 1, the
+    file is decompressed in parallel by lbzip2 or pbzip2 if one is installed, otherwise (or if it
+    fails) its bzip2 streams (files compressed by a parallel bzip2 hold many) are decompressed by a
+    process pool, and serially when the file holds a single stream.
+    An existing `path` is complete, it is kept.
+    """
+    if os.path.isfile(path):
+        logger.info(f"{path} has existed, skip decompression.")
+        return
+    logger.info(f"decompress {os.path.basename(bzpath)} to {path}")
+    name = os.path.basename(bzpath)
+    # a unique temporary file, so that concurrent conversions (e.g. d1d_to_pangu and pipeline) do not
+    # remove each other's file
+    fd, path_tmp = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.part',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    os.chmod(path_tmp, 0o644)
+    tool = next((t for t in ('lbzip2', 'pbzip2') if shutil.which(t)), None) if workers > 1 else None
+    try:
+        done = False
+        if tool is not None:
+            try:
+                with open(path_tmp, 'wb') as dst:
+                    subprocess.run([tool, '-d', '-c', f'-n{workers}' if tool == 'lbzip2' else f'-p{workers}',
+                                    bzpath], stdout=dst, check=True)
+                done = True
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"{tool} failed to decompress {name}: {e}")
+        if not done and workers > 1:
+            ranges = bz2_streams(bzpath)
+            done = len(ranges) > 1 and _decompress_streams(bzpath, path_tmp, ranges, workers)
+        if not done:
+            if workers > 1:
+                logger.info(f"{name} is decompressed serially")
+            with bz2.open(bzpath, 'rb') as src, open(path_tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+        os.replace(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+
+
+def read_cfgrib(path):
+    """Surface and upper-air datasets of a D1D file opened by cfgrib, once per parameter"""
     ds_surface = []
     for name in ('msl', '10u', '10v', '2t', '100u', '100v'):
         ds = xr.open_dataset(path, engine='cfgrib', backend_kwargs={'filter_by_keys': {'shortName': name}})
         ds_surface.append(ds)
-    ds_surface = xr.merge(ds_surface).interp(latitude=target_lats, longitude=target_lons).astype(np.float32)
-    print(ds_surface)
+    ds_surface = xr.merge(ds_surface)
 
     ds_upper = []
     levels = [1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50]
@@ -60,17 +143,150 @@ def run(it, input_dir, output_dir='/data/pangu/input/D1D'):
             ds['gh'] = ds['gh'] * 9.80665
             ds = ds.rename({'gh': 'z'})
         ds_upper.append(ds)
-    ds_upper = xr.merge(ds_upper).interp(latitude=target_lats, longitude=target_lons).astype(np.float32)
-    print(ds_upper)
+    ds_upper = xr.merge(ds_upper)
+    return ds_surface, ds_upper
+
+
+SURFACE_VARS = ('msl', 'u10', 'v10', 't2m', 'u100', 'v100')
+UPPER_VARS = ('z', 'q', 't', 'u', 'v')
+# attributes of the variables as cfgrib sets them: paramId, shortName, units, long name and standard name
+GRIB_PARAMS = {'msl': (151, 'msl', 'Pa', 'Mean sea level pressure', 'air_pressure_at_mean_sea_level'),
+               'u10': (165, '10u', 'm s**-1', '10 metre U wind component', 'eastward_wind'),
+               'v10': (166, '10v', 'm s**-1', '10 metre V wind component', 'northward_wind'),
+               't2m': (167, '2t', 'K', '2 metre temperature', 'air_temperature'),
+               'u100': (228246, '100u', 'm s**-1', '100 metre U wind component', 'eastward_wind'),
+               'v100': (228247, '100v', 'm s**-1', '100 metre V wind component', 'northward_wind'),
+               'z': (129, 'z', 'm**2 s**-2', 'Geopotential', 'geopotential'),
+               'q': (133, 'q', 'kg kg**-1', 'Specific humidity', 'specific_humidity'),
+               't': (130, 't', 'K', 'Temperature', 'air_temperature'),
+               'u': (131, 'u', 'm s**-1', 'U component of wind', 'eastward_wind'),
+               'v': (132, 'v', 'm s**-1', 'V component of wind', 'northward_wind')}
+VAR_ATTRS = {name: {'GRIB_paramId': param, 'GRIB_shortName': short_name, 'GRIB_units': units, 'GRIB_name': long_name,
+                    'GRIB_cfName': standard_name, 'GRIB_cfVarName': name, 'units': units, 'long_name': long_name,
+                    'standard_name': standard_name}
+             for name, (param, short_name, units, long_name, standard_name) in GRIB_PARAMS.items()}
+COORD_ATTRS = {'number': {'long_name': 'ensemble member numerical id', 'units': '1', 'standard_name': 'realization'},
+               'time': {'long_name': 'initial time of forecast', 'standard_name': 'forecast_reference_time'},
+               'step': {'long_name': 'time since forecast_reference_time', 'standard_name': 'forecast_period'},
+               'valid_time': {'standard_name': 'time', 'long_name': 'time'},
+               'surface': {'long_name': 'original GRIB coordinate for key: level(surface)', 'units': '1'},
+               'isobaricInhPa': {'long_name': 'pressure', 'units': 'hPa', 'positive': 'down',
+                                 'stored_direction': 'decreasing', 'standard_name': 'air_pressure'},
+               'latitude': {'units': 'degrees_north', 'standard_name': 'latitude', 'long_name': 'latitude',
+                            'stored_direction': 'decreasing'},
+               'longitude': {'units': 'degrees_east', 'standard_name': 'longitude', 'long_name': 'longitude'}}
+GLOBAL_ATTRS = {'GRIB_centre': 'ecmf', 'GRIB_centreDescription': 'European Centre for Medium-Range Weather Forecasts',
+                'Conventions': 'CF-1.7', 'institution': 'European Centre for Medium-Range Weather Forecasts'}
+
+
+def read_eccodes(path, workers=1):
+    """Fields of a D1D file decoded from a single GRIB index, see `grib.GribIndex`
+
+    Returns
+    -------
+    (fields, lats, lons), fields is a float32 array of shape (5 * 13 + 6, nj, ni), the upper-air
+    fields of UPPER_VARS on LEVELS followed by the surface fields of SURFACE_VARS
+    """
+    index = GribIndex.load(path)
+    g = index.grid
+    nupper = len(UPPER_NAMES) * len(LEVELS)
+    fields = np.empty((nupper + len(SURFACE_NAMES), g['Nj'], g['Ni']), dtype='f4')
+    index.read(LEVELS, workers, upper=fields[:nupper].reshape((len(UPPER_NAMES), len(LEVELS)) + fields.shape[1:]),
+               surface=fields[nupper:])
+    return fields, index.lats, index.lons
 
-    ds_d1d = xr.merge([ds_surface, ds_upper])
+
+def to_datasets(fields, lats, lons, inittime=None):
+    """Surface and upper-air datasets of the fields stacked as returned by `read_eccodes`
+
+    Variables and coordinates have the attributes of the datasets opened by cfgrib, with the scalar
+    time coordinates of the analysis at `inittime` when it is given.
+    """
+    nupper = len(UPPER_VARS) * len(LEVELS)
+    upper = fields[:nupper].reshape((len(UPPER_VARS), len(LEVELS)) + fields.shape[1:])
+    coords = {'latitude': ('latitude', lats, COORD_ATTRS['latitude']),
+              'longitude': ('longitude', lons, COORD_ATTRS['longitude'])}
+    if inittime is not None:
+        time = np.datetime64(inittime, 'ns')
+        coords.update({'number': ((), 0, COORD_ATTRS['number']), 'time': ((), time, COORD_ATTRS['time']),
+                       'step': ((), np.timedelta64(0, 'ns'), COORD_ATTRS['step']),
+                       'valid_time': ((), time, COORD_ATTRS['valid_time'])})
+    ds_surface = xr.Dataset({name: (('latitude', 'longitude'), d, VAR_ATTRS[name])
+                             for name, d in zip(SURFACE_VARS, fields[nupper:])},
+                            coords={**coords, 'surface': ((), 0.0, COORD_ATTRS['surface'])}, attrs=GLOBAL_ATTRS)
+    ds_upper = xr.Dataset({name: (('isobaricInhPa', 'latitude', 'longitude'), d, VAR_ATTRS[name])
+                           for name, d in zip(UPPER_VARS, upper)},
+                          coords={**coords, 'isobaricInhPa': ('isobaricInhPa', LEVELS, COORD_ATTRS['isobaricInhPa'])},
+                          attrs=GLOBAL_ATTRS)
+    return ds_surface, ds_upper
+
+
+def convert(it, input_dir, output_dir='/data/pangu/input/D1D', decompress_workers=1, engine='eccodes',
+            decode_workers=1, regrid_batch=None):
+    """Decompress, decode and regrid the D1D file of `it`, the decompressed file is kept in `output_dir`
+
+    Returns
+    -------
+    (fields, source), fields is a float32 array of shape (5 * 13 + 6, 721, 1440) stacked as returned by
+    `read_eccodes` on the 0.25 degree grid, source is the name of the D1D file
+    """
+    bzpath_wcard = f'{input_dir}/{it:%Y%m%d/%H}/W_NAFP_C_ECMF_*_P_D1D{it:%m%d%H%M}{it:%m%d%H}011.bz2'
+    bzpath = glob(bzpath_wcard)[0]
+    filename = os.path.splitext(os.path.basename(bzpath))[0]
+    path = os.path.join(output_dir, filename)
+    os.makedirs(output_dir, exist_ok=True)
+    decompress(bzpath, path, decompress_workers)
+
+    if engine == 'eccodes':
+        fields, lats, lons = read_eccodes(path, decode_workers)
+    else:
+        ds_surface, ds_upper = read_cfgrib(path)
+        lats, lons = ds_upper['latitude'].values, ds_upper['longitude'].values
+        fields = np.concatenate([np.stack([ds_upper[n].values for n in UPPER_VARS]).reshape((-1, len(lats), len(lons))),
+                                 np.stack([ds_surface[n].values for n in SURFACE_VARS])]).astype('f4')
+    # bilinear weights of the D1D grid are computed once and cached beside the decompressed files
+    regridder = Regridder.load(lats, lons, cache_dir=output_dir)
+    return regridder(fields, batch=regrid_batch), os.path.basename(bzpath)
+
+
+def input_state(fields):
+    """Model input arrays (upper, surface) of the fields returned by `convert`, views without copy"""
+    # the upper-air fields lead the stacked fields in the model input order
+    nupper = len(UPPER_VARS) * len(LEVELS)
+    return (fields[:nupper].reshape((len(UPPER_VARS), len(LEVELS)) + fields.shape[1:]),
+            fields[nupper:nupper + len(INPUT_SURFACE_VARS)])
+
+
+def write_inputs(it, fields, output_dir, formats=('netcdf', 'raw'), source=None):
+    """Write the fields returned by `convert` as Pangu inputs of `formats` in {output_dir}/{it:%Y%m%d%H}
+
+    'netcdf' is the compressed pangu_input.ecmwf_d1d.{it}.nc archived with all fields, 'raw' the
+    float32 arrays of the model inputs and their json sidecar memory-mapped by `pangu.load_input`,
+    see `reader.write_raw`.
+    """
     os.makedirs(f'{output_dir}/{it:%Y%m%d%H}', exist_ok=True)
-    ds_d1d.to_netcdf(f'{output_dir}/{it:%Y%m%d%H}/pangu_input.ecmwf_d1d.{it:%Y%m%d%H}.nc',
-                     encoding={v: {'zlib': True, 'complevel': 5} for v in ds_d1d.data_vars})
-    # np.save(f"{output_dir}/{it:%Y%m%d%H}/input_surface.npy",
-    #         ds_surface.to_array().interp(latitude=target_lats, longitude=target_lons).values.squeeze().astype(np.float32))
-    # np.save(f"{output_dir}/{it:%Y%m%d%H}/input_upper.npy",
-    #         ds_upper.to_array().interp(latitude=target_lats, longitude=target_lons).values.squeeze().astype(np.float32))
+    if 'raw' in formats:
+        write_raw(f'{output_dir}/{it:%Y%m%d%H}', *input_state(fields), inittime=f'{it:%Y%m%d%H}', source=source)
+    if 'netcdf' in formats:
+        ds_surface, ds_upper = to_datasets(fields, TARGET_LATS.astype('f4'), TARGET_LONS.astype('f4'), it)
+        print(ds_surface)
+        print(ds_upper)
+        ds_d1d = xr.merge([ds_surface, ds_upper])
+        # the netcdf4 engine holds the HDF5 lock of xarray, shared with the forecast writers (see writer.HDF5_LOCK),
+        # so the archive can be written while a forecast is running in the same process
+        ds_d1d.to_netcdf(f'{output_dir}/{it:%Y%m%d%H}/pangu_input.ecmwf_d1d.{it:%Y%m%d%H}.nc', engine='netcdf4',
+                         encoding={v: {'zlib': True, 'complevel': 5} for v in ds_d1d.data_vars})
+
+
+def run(it, input_dir, output_dir='/data/pangu/input/D1D', decompress_workers=1, engine='eccodes',
+        decode_workers=1, regrid_batch=None, formats=('raw',)):
+    """Convert the D1D file of `it` into Pangu inputs of `formats`, see `convert` and `write_inputs`
+
+    Only the raw arrays read by `pangu.load_input` are written by default, the zlib compressed NetCDF
+    takes most of the conversion time and is written only when asked for, e.g. to be archived.
+    """
+    fields, source = convert(it, input_dir, output_dir, decompress_workers, engine, decode_workers, regrid_batch)
+    write_inputs(it, fields, output_dir, formats, source)
 
 
 def main_():
@@ -97,6 +313,19 @@ def main_():
                         help='path to d1d field', default='/media/behz/nafp/ECMF-ORIG')
     parser.add_argument('--output-dir', type=str,
                         help='path to output field', default='/data/pangu/input')
+    parser.add_argument('--decompress-workers', type=int,
+                        help='number of processes decompressing the bz2 file, by lbzip2/pbzip2 if installed',
+                        default=1)
+    parser.add_argument('--engine', type=str, choices=('eccodes', 'cfgrib'),
+                        help='GRIB reader, eccodes indexes the file once and decodes only the needed messages',
+                        default='eccodes')
+    parser.add_argument('--decode-workers', type=int,
+                        help='number of threads decoding GRIB messages with the eccodes engine', default=1)
+    parser.add_argument('--regrid-batch', type=int,
+                        help='number of fields regridded at a time, all fields at once by default', default=None)
+    parser.add_argument('--format', type=str, choices=('netcdf', 'raw', 'both'),
+                        help='input files written, the raw arrays memory-mapped by pangu.py (fastest), the '
+                             'compressed NetCDF archived with all fields, or both', default='raw')
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -122,7 +351,8 @@ def main_():
 
     for it in inittimes:
         try:
-            run(it, args.input_dir, args.output_dir)
+            run(it, args.input_dir, args.output_dir, args.decompress_workers, args.engine, args.decode_workers,
+                args.regrid_batch, ('netcdf', 'raw') if args.format == 'both' else (args.format,))
             print(it)
         except Exception as e:
             logger.exception(e)
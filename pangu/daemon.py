@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 14:40
+# @Last Modified by: wqshen
+
+
+import os
+import re
+import time
+import threading
+import socketserver
+from queue import Queue
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from logzero import logger
+from pangu import run_model, load_sessions, job_memory
+from planner import STEP_LIST
+
+
+def check_inittime(inittime):
+    """Raise ValueError if the hour of `inittime` is not 0 or 12 (UTC)"""
+    if inittime.hour not in (0, 12):
+        raise ValueError(f"hour of initial time {inittime:%Y%m%d%H} must be 0 or 12 (UTC)")
+
+
+class ForecastService:
+    """Keep the sessions of all step models loaded and run forecasts of submitted initial times
+
+    Jobs are taken from a local queue (`serve_queue`), files named by initial time in a directory
+    (`serve_directory`) or lines of initial time sent to a tcp port (`serve_socket`). Up to
+    `max_jobs` forecasts run concurrently on the shared sessions, fewer if their estimated memory
+    exceeds `memory_budget`.
+
+    Examples
+    --------
+        >>>service = ForecastService('/data/pangu/input', '/data/pangu', './')
+        >>>service.submit(datetime(2023, 10, 3, 0)).result()
+        >>>service.serve(jobs_dir='/data/pangu/jobs')
+    """
+
+    def __init__(self, input_dir, output_dir, model_path, session_config=None, model_cache=None,
+                 max_jobs=1, memory_budget=None, **run_kwargs):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.model_path = model_path
+        self.run_kwargs = run_kwargs
+        plan = run_kwargs.get('plan')
+        self.sessions = load_sessions(model_path, session_config, model_cache,
+                                      plan.step_list if plan is not None else STEP_LIST)
+
+        if memory_budget is not None:
+            max_jobs = max(1, min(max_jobs, int(memory_budget // job_memory(**run_kwargs))))
+        logger.info(f"forecast service runs up to {max_jobs} concurrent jobs")
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='pangu-job')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, inittime):
+        """Queue a forecast of `inittime`, an initial time already queued or running is not queued again
+
+        Raise ValueError if the hour of `inittime` is not 0 or 12 (UTC)
+        """
+        check_inittime(inittime)
+        with self._lock:
+            future = self._futures.get(inittime)
+            if future is not None and not future.done():
+                logger.info(f"job {inittime:%Y%m%d%H} is already queued")
+                return future
+            future = self._executor.submit(self._run, inittime)
+            self._futures[inittime] = future
+        logger.info(f"job {inittime:%Y%m%d%H} is queued")
+        return future
+
+    def _run(self, inittime):
+        logger.info(f"job {inittime:%Y%m%d%H} starts")
+        try:
+            run_model(inittime, self.input_dir, self.output_dir, self.model_path, sessions=self.sessions,
+                      **self.run_kwargs)
+        except Exception as e:
+            logger.exception(e)
+            raise
+        logger.info(f"job {inittime:%Y%m%d%H} is finished")
+
+    def serve_queue(self, jobs: Queue):
+        """Submit initial times got from `jobs` until None is got"""
+        while True:
+            inittime = jobs.get()
+            if inittime is None:
+                return
+            try:
+                self.submit(inittime)
+            except ValueError as e:
+                logger.warning(f"skip job: {e}")
+
+    def serve_directory(self, jobs_dir, poll=10):
+        """Submit jobs of files named YYYYMMDDHH in `jobs_dir`
+
+        A job file is renamed with suffix .running when it is taken, then .done or .failed when finished.
+        """
+        os.makedirs(jobs_dir, exist_ok=True)
+        logger.info(f"forecast service watches {jobs_dir}")
+        while True:
+            for name in sorted(os.listdir(jobs_dir)):
+                if not re.fullmatch(r'\d{10}(\.job)?', name):
+                    continue
+                path = os.path.join(jobs_dir, name)
+                try:
+                    inittime = datetime.strptime(name[:10], '%Y%m%d%H')
+                    check_inittime(inittime)
+                    os.rename(path, f'{path}.running')
+                except (ValueError, OSError) as e:
+                    logger.warning(f"skip job file {path}: {e}")
+                    continue
+                future = self.submit(inittime)
+                future.add_done_callback(
+                    lambda f, p=path: os.rename(f'{p}.running', f'{p}.failed' if f.exception() else f'{p}.done'))
+            time.sleep(poll)
+
+    def serve_socket(self, port, host='127.0.0.1'):
+        """Submit initial times of lines (YYYYMMDDHH) sent to a tcp port, each line is answered"""
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    line = line.decode().strip()
+                    try:
+                        service.submit(datetime.strptime(line, '%Y%m%d%H'))
+                        self.wfile.write(f'queued {line}\n'.encode())
+                    except ValueError:
+                        self.wfile.write(f'invalid initial time {line}\n'.encode())
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        with socketserver.ThreadingTCPServer((host, port), Handler) as server:
+            logger.info(f"forecast service listens on {host}:{port}")
+            server.serve_forever()
+
+    def serve(self, jobs_dir=None, port=None):
+        """Serve jobs of a directory and/or a tcp port until interrupted"""
+        threads = []
+        if port is not None:
+            threads.append(threading.Thread(target=self.serve_socket, args=(port,), daemon=True))
+        if jobs_dir is not None:
+            threads.append(threading.Thread(target=self.serve_directory, args=(jobs_dir,), daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("forecast service is interrupted")
+        finally:
+            self.shutdown()
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs, wait for the running ones"""
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 19:50
+# @Last Modified by: wqshen
+
+
+import numpy as np
+from writer import LEVELS
+
+
+# derived variables on pressure levels and at surface
+UPPER_VARS = ('rh', 'ws', 'wd', 'td')
+SURFACE_VARS = ('ws10', 'wd10', 'gust')
+DERIVED_VARS = UPPER_VARS + SURFACE_VARS
+ATTRS = {'rh': {'long_name': 'Relative humidity', 'units': '%'},
+         'ws': {'long_name': 'Wind speed', 'units': 'm s**-1'},
+         'wd': {'long_name': 'Wind direction', 'units': 'degree'},
+         'td': {'long_name': 'Dew point temperature', 'units': 'K'},
+         'ws10': {'long_name': '10 metre wind speed', 'units': 'm s**-1'},
+         'wd10': {'long_name': '10 metre wind direction', 'units': 'degree'},
+         'gust': {'long_name': '10 metre wind gust', 'units': 'm s**-1'},
+         }
+# a constant gust factor over the sea, stands in for the operational sea-zone gust coefficients
+GUST_FACTOR = 1.4
+
+
+class DerivedFields:
+    """Diagnostics of a forecast step computed with vectorized NumPy into preallocated buffers
+
+    Relative humidity and dew point use the saturation vapour pressure over water of Bolton (1980),
+    wind direction is where the wind blows from, the gust is the 10 metre wind speed times a gust factor.
+    Results are written into a ring of `nbuffers` buffer sets, which must exceed the outputs held by
+    the writer (queue size + writer threads), so that a set is reused only after it has been written.
+
+    Parameters
+    ----------
+    names: iterable of str, derived variables to be computed, see DERIVED_VARS
+    region: regions.Region, optional, compute on the region instead of the globe
+    gust_factor: float, ratio of gust to 10 metre wind speed
+    nbuffers: int, number of buffer sets
+    """
+
+    def __init__(self, names=DERIVED_VARS, region=None, gust_factor=GUST_FACTOR, nbuffers=8):
+        unknown = set(names) - set(DERIVED_VARS)
+        if unknown:
+            raise ValueError(f"unknown derived variables {sorted(unknown)}, available are {DERIVED_VARS}")
+        self.names = [n for n in DERIVED_VARS if n in names]
+        self.region = region
+        self.gust_factor = gust_factor
+        ny, nx = (len(region.lats), len(region.lons)) if region is not None else (721, 1440)
+        upper, surface = (len(LEVELS), ny, nx), (ny, nx)
+        self._buffers = [{n: np.empty(upper if n in UPPER_VARS else surface, dtype='f4') for n in self.names}
+                         for _ in range(nbuffers)]
+        self._next = 0
+        # scratch arrays of intermediate results
+        self._e = np.empty(upper, dtype='f4')
+        self._es = np.empty(upper, dtype='f4')
+        self._p = (LEVELS * 100.).astype('f4')[:, None, None]
+
+    def compute(self, output, output_surface):
+        """Derived variables of a step, a dict of arrays valid until the ring of buffers wraps around"""
+        if self.region is not None:
+            output, output_surface = self.region.subset(output), self.region.subset(output_surface)
+        _, q, t, u, v = output
+        _, u10, v10, _ = output_surface
+        out = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+
+        if 'rh' in out or 'td' in out:
+            e, es = self._e, self._es
+            # vapour pressure e = q p / (0.622 + 0.378 q)
+            np.multiply(q, 0.378, out=e)
+            e += 0.622
+            np.divide(q, e, out=e)
+            e *= self._p
+            if 'rh' in out:
+                # es = 611.2 exp(17.67 (T - 273.15) / (T - 29.65))
+                np.subtract(t, 29.65, out=es)
+                np.subtract(t, 273.15, out=out['rh'])
+                np.divide(out['rh'], es, out=es)
+                es *= 17.67
+                np.exp(es, out=es)
+                es *= 611.2
+                np.divide(e, es, out=out['rh'])
+                out['rh'] *= 100
+                np.clip(out['rh'], 0, 100, out=out['rh'])
+            if 'td' in out:
+                # td = 243.5 ln(e / 611.2) / (17.67 - ln(e / 611.2)) + 273.15
+                np.maximum(e, 1e-3, out=e)
+                e /= 611.2
+                np.log(e, out=e)
+                np.subtract(17.67, e, out=es)
+                np.multiply(e, 243.5, out=out['td'])
+                out['td'] /= es
+                out['td'] += 273.15
+        if 'ws' in out:
+            np.hypot(u, v, out=out['ws'])
+        if 'wd' in out:
+            _direction(u, v, out['wd'])
+        if 'ws10' in out or 'gust' in out:
+            ws10 = out['ws10'] if 'ws10' in out else out['gust']
+            np.hypot(u10, v10, out=ws10)
+            if 'gust' in out:
+                np.multiply(ws10, self.gust_factor, out=out['gust'])
+        if 'wd10' in out:
+            _direction(u10, v10, out['wd10'])
+        return out
+
+
+def _direction(u, v, out):
+    """Meteorological wind direction, degrees clockwise from north where the wind blows from"""
+    np.arctan2(u, v, out=out)
+    np.degrees(out, out=out)
+    out += 180
+    out %= 360
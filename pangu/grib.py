@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 22:20
+# @Last Modified by: wqshen
+
+
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from logzero import logger
+from writer import LEVELS
+
+
+UPPER_NAMES = ('gh', 'q', 't', 'u', 'v')
+# 100u and 100v are not inputs of the models, they are kept in the archived input file
+SURFACE_NAMES = ('msl', '10u', '10v', '2t', '100u', '100v')
+GRAVITY = 9.80665
+# keys of the messages kept in the index
+KEYS = ('shortName', 'typeOfLevel', 'level', 'offset', 'totalLength', 'Ni', 'Nj',
+        'latitudeOfFirstGridPointInDegrees', 'latitudeOfLastGridPointInDegrees',
+        'longitudeOfFirstGridPointInDegrees', 'longitudeOfLastGridPointInDegrees')
+# integer keys, some eccodes versions return the offset as a float by default
+INT_KEYS = ('level', 'offset', 'totalLength', 'Ni', 'Nj')
+
+
+class GribIndex:
+    """Index of the messages of a GRIB file, built by a single scan and cached on disk
+
+    The index holds the offset, length, parameter, level and grid of every message, it is saved
+    as json beside the file (or in `cache_dir`) and reused as long as the size and mtime of the file
+    are unchanged. Reading decodes only the messages of the Pangu fields, each one straight from
+    its bytes, optionally by a thread pool as eccodes decodes without holding the GIL.
+
+    Examples
+    --------
+        >>>index = GribIndex.load(path)
+        >>>upper, surface = index.read(workers=4)  # (5, 13, nj, ni) and (6, nj, ni) float32
+        >>>index.lats, index.lons
+    """
+
+    def __init__(self, path, messages):
+        self.path = path
+        self.messages = messages
+        self._lookup = {(m['shortName'], m['typeOfLevel'], m['level']): m for m in reversed(messages)}
+        self._by_name = {m['shortName']: m for m in reversed(messages)}
+
+    @classmethod
+    def build(cls, path):
+        """Scan all messages of a GRIB file, their data are not decoded"""
+        import eccodes
+
+        messages = []
+        with open(path, 'rb') as f:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(f)
+                if gid is None:
+                    break
+                try:
+                    messages.append({k: eccodes.codes_get(gid, k, int) if k in INT_KEYS else eccodes.codes_get(gid, k)
+                                     for k in KEYS})
+                finally:
+                    eccodes.codes_release(gid)
+        logger.info(f"indexed {len(messages)} messages of {path}")
+        return cls(path, messages)
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """Index of a GRIB file from its cache, it is built and cached when missing or outdated"""
+        stat = os.stat(path)
+        key = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        path_index = os.path.join(cache_dir or os.path.dirname(os.path.abspath(path)),
+                                  f'{os.path.basename(path)}.idx.json')
+        if os.path.isfile(path_index):
+            try:
+                with open(path_index) as f:
+                    cached = json.load(f)
+                if cached['key'] == key:
+                    return cls(path, cached['messages'])
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"failed to read GRIB index {path_index}: {e}")
+        index = cls.build(path)
+        try:
+            os.makedirs(os.path.dirname(path_index), exist_ok=True)
+            with open(f'{path_index}.part', 'w') as f:
+                json.dump({'key': key, 'messages': index.messages}, f)
+            os.replace(f'{path_index}.part', path_index)
+        except OSError as e:
+            logger.warning(f"failed to cache GRIB index {path_index}: {e}")
+        return index
+
+    def find(self, name, level=None):
+        """Message of parameter `name`, on pressure `level` (hPa) for upper-air parameters"""
+        m = self._by_name.get(name) if level is None else self._lookup.get((name, 'isobaricInhPa', int(level)))
+        if m is None:
+            raise KeyError(f"no message of {name}" + (f" at {level} hPa" if level is not None else '') +
+                           f" in {self.path}")
+        return m
+
+    @property
+    def grid(self):
+        return self.find(SURFACE_NAMES[0])
+
+    @property
+    def lats(self):
+        g = self.grid
+        return np.linspace(g['latitudeOfFirstGridPointInDegrees'], g['latitudeOfLastGridPointInDegrees'], g['Nj'])
+
+    @property
+    def lons(self):
+        g = self.grid
+        return np.linspace(g['longitudeOfFirstGridPointInDegrees'], g['longitudeOfLastGridPointInDegrees'], g['Ni'])
+
+    def read(self, levels=LEVELS, workers=1, upper=None, surface=None):
+        """Decode the Pangu fields into float32 arrays, geopotential height is converted to geopotential
+
+        Parameters
+        ----------
+        levels: pressure levels (hPa) of the upper-air fields
+        workers: int, number of threads decoding messages
+        upper: array of shape (5, len(levels), nj, ni), optional, preallocated output
+        surface: array of shape (6, nj, ni), optional, preallocated output
+
+        Returns
+        -------
+        (upper, surface), fields of UPPER_NAMES on `levels` and of SURFACE_NAMES
+        """
+        g = self.grid
+        shape = (g['Nj'], g['Ni'])
+        if upper is None:
+            upper = np.empty((len(UPPER_NAMES), len(levels)) + shape, dtype='f4')
+        if surface is None:
+            surface = np.empty((len(SURFACE_NAMES),) + shape, dtype='f4')
+        tasks = [(self.find(name, level), upper[i, k]) for i, name in enumerate(UPPER_NAMES)
+                 for k, level in enumerate(levels)]
+        tasks += [(self.find(name), surface[i]) for i, name in enumerate(SURFACE_NAMES)]
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(lambda task: _decode(fd, *task), tasks))
+            else:
+                for task in tasks:
+                    _decode(fd, *task)
+        finally:
+            os.close(fd)
+        upper[0] *= GRAVITY
+        return upper, surface
+
+
+def _decode(fd, message, out):
+    """Decode a message read at its offset into `out`"""
+    import eccodes
+
+    gid = eccodes.codes_new_from_message(os.pread(fd, int(message['totalLength']), int(message['offset'])))
+    try:
+        out[...] = eccodes.codes_get_values(gid).reshape(out.shape)
+    finally:
+        eccodes.codes_release(gid)
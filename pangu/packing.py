@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 17:10
+# @Last Modified by: wqshen
+
+"""Packed 16-bit storage of forecast fields
+
+int16 packing stores `round((x - add_offset) / scale_factor)` with CF attributes, so xarray and other
+CF readers decode it to float transparently. Each variable has a valid range, values out of it are
+clipped, and the quantization error inside it is at most half of `scale_factor`.
+
+Example:
+    python packing.py pangu.I2023100300.024.F2023100400.nc                # error of packing a float32 file
+    python packing.py packed.nc --reference pangu.I2023100300.024.F2023100400.nc  # error of a packed file
+"""
+
+import sys
+import argparse
+import numpy as np
+import xarray as xr
+
+
+PACKINGS = ('none', 'int16', 'float16')
+# valid range of each variable in its units
+VALID_RANGE = {'gh': (-1000., 25000.),
+               'q': (0., 0.04),
+               't': (160., 340.),
+               'u': (-200., 200.),
+               'v': (-200., 200.),
+               'msl': (85000., 110000.),
+               'u10': (-100., 100.),
+               'v10': (-100., 100.),
+               't2m': (170., 350.),
+               # derived variables, see `derived.py`
+               'rh': (0., 100.),
+               'ws': (0., 300.),
+               'wd': (0., 360.),
+               'td': (150., 330.),
+               'ws10': (0., 150.),
+               'wd10': (0., 360.),
+               'gust': (0., 200.),
+               }
+FILL_VALUE = np.int16(-32768)
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def scale_offset(name):
+    """scale_factor and add_offset of a variable packed as int16, -32767 to 32767 span its valid range"""
+    vmin, vmax = VALID_RANGE[name]
+    return (vmax - vmin) / (2 ** 16 - 2), (vmax + vmin) / 2
+
+
+def float16_packable(name):
+    """Whether the valid range of a variable fits float16, msl in Pa does not and stays float32"""
+    return max(abs(v) for v in VALID_RANGE[name]) < FLOAT16_MAX
+
+
+def precision(name, packing='int16'):
+    """Maximum quantization error of a variable inside its valid range"""
+    if packing == 'int16':
+        return scale_offset(name)[0] / 2
+    if packing == 'float16' and float16_packable(name):
+        # half of the float16 spacing at the largest magnitude of the valid range
+        return float(np.spacing(np.float16(max(abs(v) for v in VALID_RANGE[name])))) / 2
+    return 0.
+
+
+def packed_encoding(names, packing='int16', output_format='netcdf'):
+    """Encoding of the packed variables, to be merged into the encoding of `to_netcdf` or `to_zarr`"""
+    if packing == 'none':
+        return {}
+    if packing == 'float16':
+        if output_format == 'netcdf':
+            raise ValueError("netcdf has no float16 type, use int16 packing or a zarr format")
+        return {name: {'dtype': 'f2'} for name in names if name in VALID_RANGE and float16_packable(name)}
+    encoding = {}
+    for name in names:
+        if name in VALID_RANGE:
+            scale, offset = scale_offset(name)
+            encoding[name] = {'dtype': 'i2', 'scale_factor': scale, 'add_offset': offset, '_FillValue': FILL_VALUE}
+    return encoding
+
+
+def clip(d, name):
+    """Clip a field to the valid range of its variable, so that the packed integers do not overflow"""
+    if name not in VALID_RANGE:
+        return d
+    return np.clip(d, *VALID_RANGE[name])
+
+
+def pack(d, name, packing='int16'):
+    """Packed array of a field, the raw data of a variable stored with `packed_encoding`"""
+    if packing == 'float16':
+        return d.astype('f2') if float16_packable(name) else d
+    scale, offset = scale_offset(name)
+    return np.round((clip(d, name) - offset) / scale).astype('i2')
+
+
+def pack_into(d, name, scratch, out):
+    """int16 packing of `pack` computed in the float32 `scratch` and written into the int16 `out`"""
+    vmin, vmax = VALID_RANGE[name]
+    scale, offset = scale_offset(name)
+    np.clip(d, vmin, vmax, out=scratch)
+    scratch -= offset
+    scratch /= scale
+    np.rint(scratch, out=scratch)
+    out[...] = scratch
+    return out
+
+
+def unpack(d, name, packing='int16'):
+    if packing == 'float16':
+        return d.astype('f4')
+    scale, offset = scale_offset(name)
+    return d.astype('f4') * scale + offset
+
+
+def verify(path, reference=None, packing='int16'):
+    """Maximum error of packed fields per variable
+
+    Parameters
+    ----------
+    path: str, a packed file compared with `reference`, or a float32 file packed in memory
+    reference: str, optional, the float32 file of the same lead time
+    packing: str, packing applied in memory when no reference is given
+
+    Returns
+    -------
+    (dict), variable name to (maximum absolute error, precision bound)
+    """
+    engine = 'zarr' if path.rstrip('/').endswith('.zarr') else None
+    with xr.open_dataset(path, engine=engine) as ds:
+        report = {}
+        ref = xr.open_dataset(reference, engine='zarr' if reference.rstrip('/').endswith('.zarr') else None) \
+            if reference is not None else None
+        for name in VALID_RANGE:
+            if name not in ds:
+                continue
+            d = ds[name].values.astype('f4')
+            if ref is None:
+                error = np.nanmax(np.abs(unpack(pack(d, name, packing), name, packing) - d))
+                bound_packing = packing
+            else:
+                error = np.nanmax(np.abs(d - ref[name].values.astype('f4')))
+                dtype = np.dtype(ds[name].encoding.get('dtype', 'f4'))
+                bound_packing = {np.dtype('f2'): 'float16', np.dtype('i2'): 'int16'}.get(dtype, 'none')
+            report[name] = (float(error), precision(name, bound_packing))
+        if ref is not None:
+            ref.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maximum quantization error of packed forecast fields',
+                                     epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', type=str, help='packed file, or float32 file to be packed in memory')
+    parser.add_argument('--reference', type=str, help='float32 file of the same lead time', default=None)
+    parser.add_argument('--packing', type=str, choices=PACKINGS[1:], default='int16',
+                        help='packing applied in memory when no reference is given')
+    args = parser.parse_args()
+
+    report = verify(args.path, args.reference, args.packing)
+    exceeded = False
+    print(f"{'variable':>8} {'max error':>12} {'bound':>12}")
+    for name, (error, bound) in report.items():
+        flag = '' if error <= bound * (1 + 1e-3) else '  exceeded, values out of valid range'
+        exceeded = exceeded or bool(flag)
+        print(f"{name:>8} {error:>12.4g} {bound:>12.4g}{flag}")
+    sys.exit(1 if exceeded else 0)
+
+
+if __name__ == '__main__':
+    main()
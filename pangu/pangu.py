@@ -7,15 +7,27 @@
 
 import os
 import sys
-import onnx
+import json
+import shutil
+import functools
 import logzero
 import argparse
 import numpy as np
 import xarray as xr
-import onnxruntime as ort
 from logzero import logger
 from datetime import time, datetime, timedelta
+from glob import glob
 from timer import Timer
+from session_config import SessionConfig, autotune, create_session, PROVIDERS, EXECUTION_MODES, GRAPH_OPTIMIZATION_LEVELS
+from packing import packed_encoding, clip, PACKINGS
+from regions import load_regions
+from stations import StationSeries, METHODS
+from buffers import BufferPool, BoundSession
+from reader import state_buffers, read_direct, read_dataset, read_raw, write_raw
+from derived import DerivedFields, ATTRS as DERIVED_ATTRS, DERIVED_VARS, GUST_FACTOR
+from planner import plan_forecast, default_lead_times, parse_lead_times, ORDERS, STEP_LIST
+from writer import AsyncWriter, RunStore, NetCDFWriter, output_path, output_encoding, OUTPUT_FORMATS, COMPRESSIONS, LEVELS, ATTRS, \
+    COORD_ATTRS, WriterError
 
 
 def infer_inittime():
@@ -29,134 +41,488 @@ def infer_inittime():
         return now.replace(hour=0, minute=0) - timedelta(days=1)
 
 
-@Timer(name='load_model_session', logger=logger.info)
-def load_model_session(hour_step=3, path='./'):
+# bytes of a forecast state, 5x13 upper-air and 4 surface float32 global fields
+STATE_BYTES = (5 * 13 + 4) * 721 * 1440 * 4
+# states held in memory by default (~2.3 GB), the others are read back from their outputs, or spilled
+# to disk when the outputs are packed
+MAX_STATES = 8
+
+
+def load_model_session(hour_step=3, path='./', config=None, cache_dir=None):
     path_model = f'{path}/pangu_weather_{hour_step}.onnx'
     logger.info(f"load {path_model} and start session")
-    model = onnx.load(path_model)
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.enable_mem_pattern = False
-    options.enable_mem_reuse = False
-    # Increase the number for faster inference and more memory consumption
-    options.intra_op_num_threads = 1
-    # Set the behavier of cuda provider
-    cuda_provider_options = {'arena_extend_strategy': 'kSameAsRequested', }
-    ort_session = ort.InferenceSession(path_model, sess_options=options,
-                                       providers=[('CUDAExecutionProvider', cuda_provider_options)])
-    return model, ort_session
+    with Timer(name=f'load_model_session.{hour_step}', logger=logger.info):
+        ort_session = create_session(path_model, config, cache_dir)
+    return ort_session
+
+
+def load_sessions(path='./', config=None, cache_dir=None, step_list=STEP_LIST):
+    """Sessions of all step models, keyed by hour step"""
+    return {hour_step: load_model_session(hour_step, path, config, cache_dir) for hour_step in step_list}
+
+
+def open_output(inittime, fh, output_dir, output_format='netcdf', region=None):
+    """Open output dataset of a lead time"""
+    path = output_path(inittime, fh, output_dir, output_format, region)
+    if output_format == 'zarr-run':
+        return xr.open_zarr(path, chunks=None).sel(time=[inittime + timedelta(hours=fh)])
+    return xr.open_dataset(path, engine='zarr' if output_format == 'zarr' else None)
 
 
 @Timer(name='write_netcdf4', logger=logger.info)
-def write(inittime, fh, output, output_surface, output_dir):
+def write(inittime, fh, output, output_surface, output_dir, output_format='netcdf', compression='none',
+          complevel=1, packing='none', region=None, derived=None):
     lats = np.linspace(90, -90, 721)
     lons = np.linspace(0, 359.75, 1440)
-    level = np.array([1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50])
-    attrs = {'gh': {'long_name': 'Geopotential height', 'units': 'gpm'},
-             'q': {'long_name': 'Specific humidity', 'units': 'kg kg**-1'},
-             't': {'long_name': 'Temperature', 'units': 'K'},
-             'u': {'long_name': 'U component of wind', 'units': 'm s**-1'},
-             'v': {'long_name': 'V component of wind', 'units': 'm s**-1'},
-             'msl': {'long_name': 'Mean sea level pressure', 'units': 'Pa'},
-             'u10': {'long_name': '10 metre U wind component', 'units': 'm s**-1'},
-             'v10': {'long_name': '10 metre V wind component', 'units': 'm s**-1m s**-1'},
-             't2m': {'long_name': '2 metre temperature', 'units': 'K'},
-             }
+    if region is not None:
+        lats, lons = region.lats, region.lons
+        output, output_surface = region.subset(output), region.subset(output_surface)
     z, q, t, u, v = output
     mslp, u10, v10, t2m = output_surface
     time = inittime + timedelta(hours=fh)
     ds = []
-    encoding = {'zlib': True, 'complevel': 1}
     for d, name in zip((z, q, t, u, v, mslp, u10, v10, t2m), ('z', 'q', 't', 'u', 'v', 'msl', 'u10', 'v10', 't2m')):
         dims = ('time', 'level', 'lat', 'lon') if d.ndim == 3 else ('time', 'lat', 'lon')
-        coords = {'time': [time], 'level': level, 'lat': lats, 'lon': lons} \
+        coords = {'time': [time], 'level': LEVELS, 'lat': lats, 'lon': lons} \
             if d.ndim == 3 else {'time': [time], 'lat': lats, 'lon': lons}
         if name == 'z':
             name = 'gh'
             d = d / 9.80665
-            attr = attrs['gh']
+            attr = ATTRS['gh']
         else:
-            attr = attrs[name]
+            attr = ATTRS[name]
+        if packing == 'int16':
+            d = clip(d, name)
 
         dar = xr.DataArray(d[None, ...], dims=dims, coords=coords, name=name, attrs=attr)
         ds.append(dar)
+    for name, d in (derived or {}).items():
+        # derived fields are computed on the globe or on the region of the file
+        if region is not None and d.shape[-2:] == (721, 1440):
+            d = region.subset(d)
+        dims = ('time', 'level', 'lat', 'lon') if d.ndim == 3 else ('time', 'lat', 'lon')
+        coords = {'time': [time], 'level': LEVELS, 'lat': lats, 'lon': lons} \
+            if d.ndim == 3 else {'time': [time], 'lat': lats, 'lon': lons}
+        if packing == 'int16':
+            d = clip(d, name)
+        ds.append(xr.DataArray(d[None, ...], dims=dims, coords=coords, name=name, attrs=DERIVED_ATTRS[name]))
     ds = xr.merge(ds)
     for v in ('level', 'lat', 'lon'):
-        coords_attrs = {'level': {'long_name': 'pressure', 'units': 'hPa'},
-                        'lat': {'long_name': 'latitude', 'units': 'degrees_north'},
-                        'lon': {'long_name': 'longitude', 'units': 'degrees_east'}}
-        for m, n in coords_attrs[v].items():
+        for m, n in COORD_ATTRS[v].items():
             ds[v].attrs[m] = n
 
-    encoding = {v: encoding for v in ds.data_vars}
+    # zlib on unchunked global fields costs 0.2s -> 5-7s, use zarr with lz4/zstd for fast compression
+    encoding = output_encoding(ds, output_format, compression, complevel)
+    for v, e in packed_encoding(ds.data_vars, packing, output_format).items():
+        encoding[v] = {**encoding.get(v, {}), **e}
     os.makedirs(f'{output_dir}/{inittime:%Y%m%d%H}', exist_ok=True)
-    # TODO: compress consume too much time, 0.2s -> 5-7s
-    ds.to_netcdf(f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}.{fh:03d}.F{time:%Y%m%d%H}.nc') #, encoding=encoding)
+    path = output_path(inittime, fh, output_dir, output_format, region)
+    # written to a temporary path and renamed, so that a file under the final name is always complete
+    path_tmp = f'{path}.part'
+    if output_format == 'zarr':
+        # numcodecs compressors are zarr v2 codecs, zarr 3 writes them only in the v2 format
+        try:
+            ds.to_zarr(path_tmp, mode='w', encoding=encoding, consolidated=True, zarr_format=2)
+        except TypeError:
+            ds.to_zarr(path_tmp, mode='w', encoding=encoding, consolidated=True)
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        ds.to_netcdf(path_tmp, encoding=encoding)
+    os.replace(path_tmp, path)
+
+
+def netcdf4_available():
+    try:
+        import netCDF4  # noqa: F401
+    except ImportError:
+        logger.warning("netCDF4 is not installed, outputs are written through xarray")
+        return False
+    return True
+
+
+def output_complete(inittime, fh, output_dir, output_format='netcdf', region=None, derived=()):
+    """Whether the output file of a lead time (of `region`) exists and is readable with all variables"""
+    path = output_path(inittime, fh, output_dir, output_format, region)
+    if not os.path.exists(path):
+        return False
+    shape = (1, len(LEVELS), len(region.lats), len(region.lons)) if region is not None else (1, len(LEVELS), 721, 1440)
+    try:
+        with open_output(inittime, fh, output_dir, output_format, region) as ds:
+            if any(name not in ds for name in (*ATTRS, *derived)) or ds['gh'].shape != shape:
+                return False
+            # a truncated file fails to read its last chunk
+            ds['t2m'][0, -1, -1].values
+    except Exception as e:
+        logger.warning(f"{path} is broken: {e}")
+        return False
+    return True
+
+
+def completed_fhs(inittime, output_dir, fhs, output_format='netcdf', region=None, derived=()):
+    """Forecast hours of `fhs` whose output (of `region`, with the `derived` variables) has been written completely
+
+    Temporary files left by an interrupted write are removed.
+    """
+    for path in glob(f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}.*.part'):
+        logger.info(f"remove partially written {path}")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return {fh for fh in fhs if output_complete(inittime, fh, output_dir, output_format, region, derived)}
+
+
+class StateStore:
+    """In-memory store of autoregressive states keyed by forecast hour
+
+    Every step of the schedule consumes the state of its parent hour `fh - hour_step`,
+    a state is kept only until the last step depending on it has consumed it.
+
+    Parameters
+    ----------
+    schedule: list of (hour_step, fh) in execution order
+    max_states: int, optional
+        maximum number of states held in memory at the same time, states beyond it are spilled
+        into `spill_dir` if it is given, otherwise dropped and read back from the output file when
+        they are needed
+    keep: set of int, optional
+        forecast hours never dropped for `max_states`, e.g. intermediate states which are not written
+    pool: buffers.BufferPool, optional
+        pool of the state buffers, the store holds a reference to the states it keeps and
+        every state returned by `pop` carries a reference to be released by the caller
+    spill_dir: str, optional
+        directory of the spilled states, written as raw input files (see `reader.write_raw`) and
+        memory-mapped back, so they are exact whatever the packing of the outputs
+    """
+
+    def __init__(self, schedule, max_states=None, keep=None, pool=None, spill_dir=None):
+        self.max_states = max_states
+        self.keep = keep or set()
+        self.pool = pool
+        self.spill_dir = spill_dir
+        self._states = {}
+        self._spilled = set()
+        self._consumers = {}
+        for hour_step, fh in schedule:
+            self._consumers[fh - hour_step] = self._consumers.get(fh - hour_step, 0) + 1
+
+    def __contains__(self, fh):
+        return fh in self._states or fh in self._spilled
+
+    def __len__(self):
+        return len(self._states)
+
+    def put(self, fh, input, input_surface):
+        """Keep the state of `fh` if a later step still needs it"""
+        if self._consumers.get(fh, 0) <= 0 or fh in self:
+            return
+        if self.max_states is not None and len(self._states) >= self.max_states and fh not in self.keep:
+            if self.spill_dir is not None and input is not None:
+                logger.debug(f"state store is full, spill state of fh={fh:03d}")
+                write_raw(self._spill_path(fh), input, input_surface)
+                self._spilled.add(fh)
+            else:
+                logger.debug(f"state store is full, drop state of fh={fh:03d}")
+            return
+        self._states[fh] = (input, input_surface)
+        if self.pool is not None:
+            self.pool.retain(input)
+
+    def pop(self, fh):
+        """Consume the state of `fh`, it is evicted once no later step needs it"""
+        self._consumers[fh] = self._consumers.get(fh, 0) - 1
+        if fh in self._spilled:
+            return self._unspill(fh, self._consumers[fh] <= 0)
+        if self._consumers[fh] > 0:
+            state = self._states.get(fh)
+            if state is not None and self.pool is not None:
+                self.pool.retain(state[0])
+            return state
+        # the reference of the store passes to the caller
+        return self._states.pop(fh, None)
+
+    def _spill_path(self, fh):
+        return os.path.join(self.spill_dir, f'{fh:03d}')
+
+    def _unspill(self, fh, last):
+        """Memory-map a spilled state, its files are removed after the last consumer has mapped them"""
+        state = read_raw(self._spill_path(fh))
+        if last:
+            self._spilled.discard(fh)
+            # the mapping stays valid once the files are unlinked
+            shutil.rmtree(self._spill_path(fh), ignore_errors=True)
+        return state
+
+    @classmethod
+    def peak(cls, schedule, max_states=None):
+        """Maximum number of states held while running the schedule"""
+        states, peak = cls(schedule, max_states), 0
+        for hour_step, fh in schedule:
+            if states.pop(fh - hour_step) is None:
+                states.put(fh - hour_step, None, None)
+            states.put(fh, None, None)
+            peak = max(peak, len(states))
+        return peak
+
+
+def job_memory(max_states=MAX_STATES, writer_queue=4, writer_memory=None, plan=None, **kwargs):
+    """Estimated memory (bytes) of a forecast run, its peak states, input, output and pending writes"""
+    plan = plan or plan_forecast(default_lead_times())
+    peak = StateStore.peak(plan.schedule, max_states)
+    if writer_memory is None:
+        writer_memory = writer_queue * STATE_BYTES
+    return (peak + 2) * STATE_BYTES + writer_memory
 
 
 @Timer(name='load_pangu_input', logger=logger.info)
-def load_input(inittime, fh, hour_step, input_dir, output_dir):
-    def prepare_input(path):
-        ds = xr.open_dataset(path)
-        if 'z' not in ds and 'gh' in ds:
-            ds['z'] = ds['gh'] * 9.80665
-        input = ds[upper_vars].to_array().squeeze().values.astype('f4')
-        input_surface = ds[surf_vars].to_array().squeeze().values.astype('f4')
-        return input, input_surface
-
-    surf_vars = ['msl', 'u10', 'v10', 't2m']
-    upper_vars = ['z', 'q', 't', 'u', 'v']
-    input, input_surface = None, None
-    if fh == hour_step:
+def load_input(inittime, fh, hour_step, input_dir, output_dir, states=None, output_format='netcdf', pool=None):
+    """State the step of `fh` starts from, from memory or read from the input or output file
+
+    States read from files are decoded variable by variable into the slices of one float32 buffer,
+    acquired from `pool` if it is given, NetCDF4 files are read with h5py straight into the buffer.
+    The initial state is memory-mapped from the raw input files (see `reader.write_raw`) when they
+    exist, the arrays are then fed to the model as they are.
+    """
+    input_fh = fh - hour_step
+    if states is not None:
+        state = states.pop(input_fh)
+        if state is not None:
+            logger.info(f"{inittime:%Y%m%d%H}-{input_fh:03d}-memory")
+            return state
+    if input_fh == 0:
+        raw = read_raw(f'{input_dir}/{inittime:%Y%m%d%H}')
+        if raw is not None:
+            logger.info(f"{inittime:%Y%m%d%H}-{input_fh:03d}-raw")
+            if states is not None:
+                states.put(input_fh, *raw)
+            return raw
         p = f'{input_dir}/{inittime:%Y%m%d%H}/pangu_input.ecmwf_d1d.{inittime:%Y%m%d%H}.nc'
-        logger.info(f"{inittime:%Y%m%d%H}-{fh:03d}-{p}")
-        input, input_surface = prepare_input(p)
     else:
-        step_list = (24, 6, 3, 1)
-        for step in step_list:
-            if fh % step == hour_step:
-                input_fh = fh - hour_step
-                ld = inittime + timedelta(hours=input_fh)
-                p = f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}.{input_fh:03d}.F{ld:%Y%m%d%H}.nc'
-                logger.info(f"{inittime:%Y%m%d%H}-{input_fh:03d}-{p}")
-                input, input_surface = prepare_input(p)
-                break
+        p = output_path(inittime, input_fh, output_dir, output_format)
+    logger.info(f"{inittime:%Y%m%d%H}-{input_fh:03d}-{p}")
+    input, input_surface = state_buffers(pool)
+    try:
+        direct = (input_fh == 0 or output_format == 'netcdf') and read_direct(p, input, input_surface)
+        if not direct:
+            with (xr.open_dataset(p) if input_fh == 0 else
+                  open_output(inittime, input_fh, output_dir, output_format)) as ds:
+                read_dataset(ds, input, input_surface)
+    except Exception:
+        if pool is not None:
+            pool.release(input)
+        raise
+    if states is not None:
+        # cold start or evicted state, keep it for the remaining consumers
+        states.put(input_fh, input, input_surface)
     return input, input_surface
 
 
-def run_model(inittime, input_dir, output_dir, model_path):
-    step_list = (24, 6, 3, 1)
-    for i, hourstep in enumerate(step_list):
-        model, session = load_model_session(hourstep, model_path)
-        for fh in range(hourstep, 360 + 1, hourstep):
-            if any([fh % pre == 0 for pre in step_list[:i]]):
-                continue
-            if hourstep == 1 and fh > 84:
-                continue
-            logger.info(f"processing at inittime={inittime:%Y%m%d%H}, fh={fh:03d}")
-            input, input_surface = load_input(inittime, fh, hourstep, input_dir, output_dir)
-            if input is None and input_surface is None:
-                logger.info("using previous output as input.")
-                input, input_surface = input_pre, input_surface_pre
-            with Timer(name='pangu_inference', logger=logger.info):
-                output, output_surface = session.run(None, {'input': input, 'input_surface': input_surface})
-            write(inittime, fh, output, output_surface, output_dir)
-            input_pre, input_surface_pre = output, output_surface
-        del model, session, input, input_surface, output, output_surface, input_pre, input_surface_pre
+def run_model(inittime, input_dir, output_dir, model_path, max_states=MAX_STATES,
+              writer_queue=4, writer_memory=None, writer_workers=1,
+              output_format='netcdf', compression='none', complevel=1, session_config=None,
+              model_cache=None, sessions=None, resume=False, plan=None, packing='none', regions=(),
+              stations=None, station_method='bilinear', derived=(), derived_region=None,
+              gust_factor=GUST_FACTOR, metrics_dir=None, track_memory=False, trace_allocations=False,
+              io_binding=False, initial_state=None):
+    """Run a forecast of `inittime`
+
+    The steps come from `plan` (see `planner.plan_forecast`), the operational lead times by default.
+    Step models are loaded one after another, unless preloaded `sessions` keyed by hour step are given.
+    At most `max_states` states are held in memory (None is unlimited), the others are read back from
+    their outputs once written, or with `packing` (lossy outputs) spilled exactly into
+    {output_dir}/{inittime}/.states until the steps they start are run.
+    With `resume`, lead times already written completely are skipped, and the states they leave
+    to the remaining steps are read back from their outputs. Each of `regions` is written alongside
+    the global field in its own file or store. With a `stations` csv, all variables are sampled at the
+    stations after each step and written into one table, pangu.I{inittime}.stations.nc.
+    The `derived` variables (see `derived.py`) are computed once per step on the globe, or on
+    `derived_region` only, and written with the outputs covering their grid.
+    Timers of the run are labelled with the initial time, hour step and forecast hour; with `metrics_dir`
+    their report is written as pangu.I{inittime}.metrics.json and the Prometheus textfile pangu.prom.
+    With `track_memory`, timers also record the RSS (and with `trace_allocations` the tracemalloc traced
+    memory) per stage and lead time, the high-watermark and largest allocations of the run are logged
+    and written as pangu.I{inittime}.memory.json and pangu_memory.prom.
+    With `io_binding`, steps run with ORT IOBinding into reference counted buffers of a `BufferPool`,
+    which are shared by the state store, the writer and the next steps without copies and reused
+    once all of them are done, so steps allocate no new state arrays once the pool has grown.
+    NetCDF outputs are written by a `NetCDFWriter` per global field and region, built once per run.
+    An `initial_state` (upper, surface) already in memory, e.g. converted by `pipeline.py`, is used
+    instead of reading the input files.
+    """
+    if track_memory or trace_allocations:
+        Timer.memory.enable(trace=trace_allocations)
+        # the high-watermark is process wide, it covers the concurrent jobs of a daemon
+        Timer.memory.reset_peak()
+    plan = plan or plan_forecast(default_lead_times())
+    fhs = sorted(plan.outputs)
+    targets = (None, *regions)
+    if derived:
+        if derived_region is not None and derived_region not in regions:
+            raise ValueError(f"derived region {derived_region.name} must be one of the written regions")
+        fields = DerivedFields(derived, derived_region, gust_factor,
+                               nbuffers=writer_queue + writer_workers + 1)
+        # outputs receiving the derived fields
+        derived_targets = [derived_region is None or region == derived_region for region in targets]
+    else:
+        fields, derived_targets = None, [False] * len(targets)
+    if output_format == 'zarr-run':
+        os.makedirs(f'{output_dir}/{inittime:%Y%m%d%H}', exist_ok=True)
+        stores = [RunStore(output_path(inittime, 0, output_dir, output_format, region), inittime, fhs,
+                           compression, complevel, resume=resume, packing=packing, region=region,
+                           derived=derived if has_derived else ())
+                  for region, has_derived in zip(targets, derived_targets)]
+        writes = [store.write for store in stores]
+        done = set.intersection(*(set(store.completed) for store in stores))
+    elif output_format == 'netcdf' and netcdf4_available():
+        writes = [NetCDFWriter(output_dir, compression, complevel, packing, region,
+                               derived=derived if has_derived else ()).write
+                  for region, has_derived in zip(targets, derived_targets)]
+    else:
+        writes = [functools.partial(write, output_dir=output_dir, output_format=output_format,
+                                    compression=compression, complevel=complevel, packing=packing, region=region)
+                  for region in targets]
+    if output_format != 'zarr-run':
+        # a lead time is skipped only if the files of the globe and of all regions are complete
+        done = set.intersection(*(completed_fhs(inittime, output_dir, fhs, output_format, region,
+                                                derived if has_derived else ())
+                                  for region, has_derived in zip(targets, derived_targets))) if resume else set()
+    if stations is not None:
+        path_series = f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}.stations.nc'
+        series = StationSeries(stations, inittime, fhs, station_method)
+        if resume:
+            series.load(path_series)
+            # and the lead time has been sampled at the stations
+            done &= series.completed
+    if done:
+        plan = plan.exclude(done)
+        logger.info(f"resume {inittime:%Y%m%d%H}, {len(done)} lead times completed, {len(plan)} steps to run")
+    if sessions is None and plan.order == 'depth-first':
+        # depth-first plans switch models between steps, all of them are kept loaded
+        sessions = load_sessions(model_path, session_config, model_cache, plan.step_list)
+    # buffers of the state being read, the output being computed and the outputs being written
+    pool = BufferPool(writer_queue + writer_workers + 2) if io_binding else None
+    # unpacked outputs hold the exact states, which are then read back from them instead of being
+    # written twice on the inference thread; spilled states are removed at the end of the run
+    spill_dir = f'{output_dir}/{inittime:%Y%m%d%H}/.states' if packing != 'none' else None
+    states = StateStore(plan.schedule, max_states=max_states, keep={s.fh for s in plan.steps if not s.output},
+                        pool=pool, spill_dir=spill_dir)
+    if initial_state is not None:
+        states.put(0, *initial_state)
+
+    def write_outputs(*item, derived=None):
+        try:
+            for w, has_derived in zip(writes, derived_targets):
+                if has_derived and derived is not None:
+                    w(*item, derived=derived)
+                else:
+                    w(*item)
+        finally:
+            if pool is not None:
+                pool.release(item[2])
 
+    writer = AsyncWriter(write_outputs, max_queue=writer_queue, max_bytes=writer_memory,
+                         workers=writer_workers)
 
-def run():
-    example_text = """Example:
-     python pangu -r"""
+    session, session_step, bound = None, None, None
+    labels = {'inittime': f'{inittime:%Y%m%d%H}'}
+    writer_error = None
+    with Timer.labelled(**labels):
+        try:
+            for step in plan.steps:
+                hourstep, fh = step.hour_step, step.fh
+                if hourstep != session_step:
+                    # release the previous session before the next one is loaded
+                    session, bound = None, None
+                    session = sessions[hourstep] if sessions is not None else \
+                        load_model_session(hourstep, model_path, session_config, model_cache)
+                    session_step = hourstep
+                    if pool is not None:
+                        bound = BoundSession(session, pool)
+                logger.info(f"processing at inittime={inittime:%Y%m%d%H}, fh={fh:03d}")
+                with Timer.labelled(step=hourstep, fh=f'{fh:03d}'):
+                    if step.parent not in states:
+                        # state will be read from disk, make sure it has been written
+                        writer.wait(step.parent)
+                    input, input_surface = load_input(inittime, fh, hourstep, input_dir, output_dir, states,
+                                                       output_format, pool)
+                    with Timer(name='pangu_inference', logger=logger.info):
+                        if bound is not None:
+                            output, output_surface = bound.run(input, input_surface)
+                        else:
+                            output, output_surface = session.run(None, {'input': input,
+                                                                        'input_surface': input_surface})
+                    if step.output:
+                        derived_fields = None
+                        if fields is not None:
+                            with Timer(name='derived_fields', logger=logger.debug):
+                                derived_fields = fields.compute(output, output_surface)
+                        if pool is not None:
+                            # released by write_outputs
+                            pool.retain(output)
+                        writer.submit(inittime, fh, output, output_surface, derived_fields)
+                        if stations is not None:
+                            series.add(fh, output, output_surface)
+                    states.put(fh, output, output_surface)
+                    if pool is not None:
+                        pool.release(input)
+                        pool.release(output)
+                    del input, input_surface, output, output_surface
+        finally:
+            with Timer(name='writer_flush', logger=logger.info):
+                try:
+                    writer.close()
+                except WriterError as e:
+                    # raised after the cleanup, never in place of the error of a step
+                    writer_error = e
+            if stations is not None:
+                os.makedirs(f'{output_dir}/{inittime:%Y%m%d%H}', exist_ok=True)
+                series.write(path_series)
+            if metrics_dir is not None:
+                Timer.registry.write_json(f'{metrics_dir}/pangu.I{inittime:%Y%m%d%H}.metrics.json', match=labels)
+                Timer.registry.write_prometheus(f'{metrics_dir}/pangu.prom', prefix='pangu', keep=('step',),
+                                                match=labels)
+            if Timer.memory.enabled:
+                report_memory(inittime, metrics_dir, labels)
+            # series of the run are dropped, so that a long-running daemon does not accumulate them
+            Timer.registry.reset(match=labels)
+            Timer.memory.registry.reset(match=labels)
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+    del session, bound, states
+    if writer_error is not None:
+        raise writer_error
 
-    package_root = os.path.abspath(os.path.dirname(__file__))
 
-    def time_parser(s):
-        return datetime.strptime(s, '%Y%m%d%H')
+def report_memory(inittime, metrics_dir=None, labels=None, top=10):
+    """Log the memory high-watermark and largest allocations of a run, and write them into `metrics_dir`"""
+    hwm, allocations = Timer.memory.high_watermark(), Timer.memory.top_allocations(top)
+    rss = Timer.memory.snapshot()['rss']
+    if hwm['rss'] is not None:
+        logger.info(f"memory of {inittime:%Y%m%d%H}: rss {rss / 2 ** 20:0.0f} MB, "
+                    f"high-watermark {hwm['rss'] / 2 ** 20:0.0f} MB")
+    if hwm['traced'] is not None:
+        logger.info(f"traced memory high-watermark {hwm['traced'] / 2 ** 20:0.0f} MB, largest allocations:")
+        for a in allocations:
+            logger.info(f"  {a['size'] / 2 ** 20:8.1f} MB {a['count']:>8} blocks  {a['location']}")
+    if metrics_dir is not None:
+        report = {'rss': rss, 'high_watermark': hwm, 'top_allocations': allocations,
+                  **Timer.memory.registry.report(match=labels)}
+        path = f'{metrics_dir}/pangu.I{inittime:%Y%m%d%H}.memory.json'
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(f'{path}.part', 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(f'{path}.part', path)
+        Timer.memory.registry.write_prometheus(f'{metrics_dir}/pangu_memory.prom', prefix='pangu_memory',
+                                               keep=('step',), match=labels, unit='bytes',
+                                               description='Memory at the end of timed stages')
 
-    parser = argparse.ArgumentParser(description='Forecast',
-                                     epilog=example_text,
-                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+def time_parser(s):
+    return datetime.strptime(s, '%Y%m%d%H')
+
+
+def add_time_arguments(parser):
+    """Arguments of the initial times and log level, see `parse_inittimes`"""
     parser.add_argument('-r', '--realtime', action='store_true',
                         help='realtime run', )
     parser.add_argument('-t', '--time', type=time_parser,
@@ -167,37 +533,263 @@ def run():
                         help='end time (UTC, except tp01 BJT', default=None)
     parser.add_argument('-o', '--loglevel', type=int,
                         help='loglevel: 10, 20, 30, 40, 50', default=20)
+
+
+def parse_inittimes(args):
+    """Initial times of the arguments added by `add_time_arguments`"""
+    # time check
+    if (args.time is not None and args.time.hour not in (0, 12) or
+            (args.start is not None and args.start.hour not in (0, 12)) or
+            (args.end is not None and args.end.hour not in (0, 12))):
+        raise ValueError("hour of time, start and end must be 0 or 12 (UTC) ")
+    if args.realtime:
+        return [infer_inittime(), ]
+    elif args.start is not None and args.end is not None:
+        return np.arange(args.start, args.end + timedelta(hours=1),
+                         np.timedelta64(12, 'h'), dtype='datetime64[h]').astype(datetime)
+    return [args.time, ]
+
+
+def add_forecast_arguments(parser):
+    """Arguments of `run_model` and of the sessions, shared by pangu.py and pipeline.py, see `forecast_options`"""
     parser.add_argument('--input-dir', type=str,
                         help='path to input field', default='/data/pangu/input')
     parser.add_argument('--output-dir', type=str,
                         help='path to output field', default='/data/pangu')
     parser.add_argument('--model-path', type=str,
                         help='path to pretrained model', default='./')
+    parser.add_argument('--max-states', type=int,
+                        help='maximum number of forecast states (~286 MB each) kept in memory, the others are '
+                             'read back from the outputs, or spilled to disk with --packing, 0 is unlimited',
+                        default=MAX_STATES)
+    parser.add_argument('--writer-queue', type=int,
+                        help='maximum number of outputs waiting to be written in background', default=4)
+    parser.add_argument('--writer-memory', type=int,
+                        help='maximum memory (MB) of outputs waiting to be written, unlimited by default',
+                        default=None)
+    parser.add_argument('--writer-workers', type=int,
+                        help='number of background writer threads', default=1)
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS,
+                        help='format of output field, zarr-run writes a single zarr store per initial time',
+                        default='netcdf')
+    parser.add_argument('--compression', type=str, choices=COMPRESSIONS,
+                        help='compression of output field, lz4 and zstd are fast with zarr format',
+                        default='none')
+    parser.add_argument('--complevel', type=int,
+                        help='compression level of output field', default=1)
+    parser.add_argument('--packing', type=str, choices=PACKINGS,
+                        help='packed 16-bit storage of output field, float16 requires a zarr format',
+                        default='none')
+    parser.add_argument('--regions', type=lambda s: s.split(','),
+                        help='regions written alongside the global field, e.g. china,zhejiang', default=())
+    parser.add_argument('--regions-config', type=str,
+                        help='json file of region boxes {name: [lon_min, lon_max, lat_min, lat_max]}', default=None)
+    parser.add_argument('--stations', type=str,
+                        help='csv file of stations (name, lon, lat) sampled into a time series table, '
+                             'e.g. stations.csv', default=None)
+    parser.add_argument('--station-method', type=str, choices=METHODS,
+                        help='interpolation of fields to stations', default='bilinear')
+    parser.add_argument('--derived', type=lambda s: DERIVED_VARS if s == 'all' else tuple(s.split(',')),
+                        help=f'derived variables written with the output, all or some of {",".join(DERIVED_VARS)}',
+                        default=())
+    parser.add_argument('--derived-region', type=str,
+                        help='compute the derived variables on one of --regions only', default=None)
+    parser.add_argument('--gust-factor', type=float,
+                        help='ratio of gust to 10 metre wind speed of the gust diagnostic', default=GUST_FACTOR)
+    parser.add_argument('--metrics-dir', type=str,
+                        help='directory of the timing report (json) and Prometheus textfile (pangu.prom) of '
+                             'each run, e.g. the node exporter textfile collector directory', default=None)
+    parser.add_argument('--track-memory', action='store_true',
+                        help='record the RSS per stage and lead time and log the high-watermark of each run', )
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='also trace Python allocations with tracemalloc and report the largest ones, '
+                             'slows down the run', )
+    parser.add_argument('--io-binding', action='store_true',
+                        help='run the steps with ORT IOBinding into a pool of reused state buffers', )
+    parser.add_argument('--provider', type=str, choices=PROVIDERS,
+                        help='execution provider, cpu uses the CPU profile as defaults', default=None)
+    parser.add_argument('--session-config', type=str,
+                        help='json file of session options, e.g. saved by --autotune', default=None)
+    parser.add_argument('--intra-op-threads', type=int,
+                        help='number of threads used to parallelize an operator', default=None)
+    parser.add_argument('--inter-op-threads', type=int,
+                        help='number of threads used to run operators in parallel', default=None)
+    parser.add_argument('--execution-mode', type=str, choices=tuple(EXECUTION_MODES),
+                        help='execution mode of the operators', default=None)
+    parser.add_argument('--graph-optimization', type=str, choices=tuple(GRAPH_OPTIMIZATION_LEVELS),
+                        help='graph optimization level', default=None)
+    parser.add_argument('--cpu-mem-arena', action=argparse.BooleanOptionalAction,
+                        help='enable the cpu memory arena, memory pattern and memory reuse', default=None)
+    parser.add_argument('--model-cache', type=str,
+                        help='directory of cached optimized models, default is ort_cache in --model-path',
+                        default=None)
+    parser.add_argument('--no-model-cache', action='store_true',
+                        help='always optimize the models when the sessions are created', )
+    parser.add_argument('--lead-times', type=parse_lead_times,
+                        help='forecast hours to be written, e.g. 1-120 or 3-240/3, default is 1-84,87-360/3',
+                        default=None)
+    parser.add_argument('--step-models', type=lambda s: tuple(int(h) for h in s.split(',')),
+                        help='hour steps of the models to be used, e.g. 24,6,3', default=(24, 6, 3, 1))
+    parser.add_argument('--order', type=str, choices=ORDERS,
+                        help='execution order of the steps, depth-first keeps fewer states in memory but '
+                             'keeps all step models loaded', default='by-model')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip lead times already written completely and restart from their states', )
+
+
+def session_options(parser, args):
+    """Session config and model cache directory of the arguments added by `add_forecast_arguments`
+
+    A missing `--session-config` exits through `parser.error`, unless `--autotune` is to create it.
+    `--autotune` tunes the CPU profile unless `--provider` is given.
+    """
+    autotuning = getattr(args, 'autotune', False)
+    if args.session_config is not None and os.path.isfile(args.session_config):
+        session_config = SessionConfig.load(args.session_config)
+    elif args.session_config is not None and not autotuning:
+        parser.error(f"session config {args.session_config} does not exist, create it with --autotune")
+    elif args.provider == 'cpu' or (autotuning and args.provider is None):
+        session_config = SessionConfig.cpu()
+    else:
+        session_config = SessionConfig()
+    arena = args.cpu_mem_arena
+    session_config = session_config.update(provider=args.provider, intra_op_num_threads=args.intra_op_threads,
+                                           inter_op_num_threads=args.inter_op_threads,
+                                           execution_mode=args.execution_mode,
+                                           graph_optimization_level=args.graph_optimization,
+                                           enable_cpu_mem_arena=arena, enable_mem_pattern=arena,
+                                           enable_mem_reuse=arena)
+    model_cache = None if args.no_model_cache else (args.model_cache or f'{args.model_path}/ort_cache')
+    return session_config, model_cache
+
+
+def forecast_options(parser, args):
+    """Plan and keyword arguments of `run_model` of the arguments added by `add_forecast_arguments`
+
+    Invalid combinations of arguments exit through `parser.error`.
+    """
+    if args.packing == 'float16' and args.output_format == 'netcdf':
+        parser.error("netcdf has no float16 type, use --packing int16 or a zarr --output-format")
+    unknown = set(args.derived) - set(DERIVED_VARS)
+    if unknown:
+        parser.error(f"unknown derived variables {sorted(unknown)}, available are {','.join(DERIVED_VARS)}")
+    if args.derived_region is not None and args.derived_region not in args.regions:
+        parser.error("--derived-region must be one of --regions")
+    writer_memory = args.writer_memory * 2 ** 20 if args.writer_memory is not None else None
+    try:
+        plan = plan_forecast(args.lead_times or default_lead_times(), args.step_models, args.order)
+    except ValueError as e:
+        # lead times not reachable by the step models
+        parser.error(str(e))
+    regions = load_regions(args.regions, args.regions_config)
+    derived_region = next((r for r in regions if r.name == args.derived_region), None)
+    run_kwargs = dict(plan=plan, max_states=args.max_states or None, writer_queue=args.writer_queue,
+                      writer_memory=writer_memory, writer_workers=args.writer_workers, output_format=args.output_format,
+                      compression=args.compression, complevel=args.complevel, resume=args.resume,
+                      packing=args.packing, regions=regions, stations=args.stations,
+                      station_method=args.station_method, derived=args.derived, derived_region=derived_region,
+                      gust_factor=args.gust_factor, metrics_dir=args.metrics_dir, track_memory=args.track_memory,
+                      trace_allocations=args.trace_allocations, io_binding=args.io_binding)
+    return plan, run_kwargs
+
+
+def run():
+    example_text = """Example:
+     python pangu -r"""
+
+    package_root = os.path.abspath(os.path.dirname(__file__))
+
+    parser = argparse.ArgumentParser(description='Forecast',
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_time_arguments(parser)
+    add_forecast_arguments(parser)
+    parser.add_argument('--plan', action='store_true',
+                        help='print the forecast plan with estimated cost and exit', )
+    parser.add_argument('--step-seconds', type=float,
+                        help='inference seconds per step used by --plan to estimate the time', default=None)
+    parser.add_argument('--serve-dir', type=str,
+                        help='run as a daemon keeping all models loaded, taking jobs from files named by '
+                             'initial time (YYYYMMDDHH) in this directory', default=None)
+    parser.add_argument('--serve-port', type=int,
+                        help='run as a daemon keeping all models loaded, taking jobs from lines of initial '
+                             'time (YYYYMMDDHH) sent to this localhost tcp port', default=None)
+    parser.add_argument('--max-jobs', type=int,
+                        help='maximum number of concurrent jobs of the daemon', default=1)
+    parser.add_argument('--memory-budget', type=float,
+                        help='memory (GB) available for concurrent jobs of the daemon, unlimited by default',
+                        default=None)
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes running --start/--end initial times in parallel',
+                        default=1)
+    parser.add_argument('--cores-per-worker', type=int,
+                        help='number of cores pinned to each worker, all cores are split evenly by default',
+                        default=None)
+    parser.add_argument('--memory-cap', type=float,
+                        help='memory (GB) available for all workers, unlimited by default', default=None)
+    parser.add_argument('--preload-models', action='store_true',
+                        help='keep the sessions of all step models loaded across --start/--end initial times, '
+                             'faster hindcasts at the cost of the memory of all models at once', )
+    parser.add_argument('--autotune', action='store_true',
+                        help='benchmark session options of --provider (cpu by default) on synthetic input and '
+                             'save the fastest one to --session-config', )
+    parser.add_argument('--autotune-step', type=int, choices=(24, 6, 3, 1),
+                        help='hour step of the model benchmarked by --autotune', default=24)
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
     args = parser.parse_args()
-    # time check
-    if (args.time is not None and args.time.hour not in (0, 12) or
-            (args.start is not None and args.start.hour not in (0, 12)) or
-            (args.end is not None and args.end.hour not in (0, 12))):
-        raise ValueError("hour of time, start and end must be 0 or 12 (UTC) ")
-
     logzero.loglevel(args.loglevel)
+
+    session_config, model_cache = session_options(parser, args)
+    if args.autotune:
+        path_config = args.session_config or f'{args.model_path}/session_config.json'
+        best, t = autotune(f'{args.model_path}/pangu_weather_{args.autotune_step}.onnx', session_config)
+        best.save(path_config, autotune_seconds=t)
+        logger.info(f"fastest session config {best} ({t:0.4f} seconds) saved to {path_config}")
+        return
+
+    plan, run_kwargs = forecast_options(parser, args)
+    if args.plan:
+        print(plan.describe(args.step_seconds, STATE_BYTES, run_kwargs['max_states'], spill=args.packing != 'none'))
+        return
+
+    if args.serve_dir is not None or args.serve_port is not None:
+        from daemon import ForecastService
+
+        memory_budget = args.memory_budget * 2 ** 30 if args.memory_budget is not None else None
+        service = ForecastService(args.input_dir, args.output_dir, args.model_path, session_config, model_cache,
+                                  max_jobs=args.max_jobs, memory_budget=memory_budget, **run_kwargs)
+        service.serve(jobs_dir=args.serve_dir, port=args.serve_port)
+        return
+
+    inittimes = parse_inittimes(args)
     logger.debug(args)
 
-    if args.realtime:
-        inittimes = [infer_inittime(), ]
-    elif args.start is not None and args.end is not None:
-        inittimes = np.arange(args.start, args.end + timedelta(hours=1),
-                              np.timedelta64(12, 'h'), freq='datetime64[h]')
-    else:
-        inittimes = [args.time, ]
+    if args.workers > 1 and len(inittimes) > 1:
+        from backfill import backfill
+
+        memory_cap = args.memory_cap * 2 ** 30 if args.memory_cap is not None else None
+        failures = backfill(inittimes, args.input_dir, args.output_dir, args.model_path, args.workers,
+                            args.cores_per_worker, memory_cap, session_config, model_cache, **run_kwargs)
+        if failures:
+            logger.error(f"backfill failed for {len(failures)} initial times: "
+                         f"{', '.join(f'{it:%Y%m%d%H}' for it in sorted(failures))}")
+            sys.exit(1)
+        return
 
+    # hindcasts may keep all step models loaded across initial times
+    sessions = load_sessions(args.model_path, session_config, model_cache, plan.step_list) \
+        if args.preload_models and len(inittimes) > 1 else None
     for it in inittimes:
-        run_model(it, args.input_dir, args.output_dir, args.model_path)
+        try:
+            run_model(it, args.input_dir, args.output_dir, args.model_path, session_config=session_config,
+                      model_cache=model_cache, sessions=sessions, **run_kwargs)
+        except Exception as e:
+            logger.exception(e)
+            continue
 
 
 if __name__ == '__main__':
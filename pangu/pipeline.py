@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 23:30
+# @Last Modified by: wqshen
+
+
+import sys
+import logzero
+import argparse
+from logzero import logger
+from concurrent.futures import ThreadPoolExecutor
+from timer import Timer
+from planner import plan_forecast, default_lead_times
+from pangu import run_model, load_model_session, add_time_arguments, add_forecast_arguments, parse_inittimes, \
+    session_options, forecast_options
+from d1d_to_pangu import convert, input_state, write_inputs
+
+
+class SessionPrefetcher:
+    """Sessions of step models keyed by hour step, loading in a background thread from creation
+
+    The session of the first step is loaded while the D1D file is decoded, the sessions of the other
+    steps are loaded when asked for, and not kept, so `run_model` releases each one before the next is
+    loaded as it does without preloaded sessions. With `keep` (depth-first plans switch models between
+    steps), the sessions of all steps are loaded in background and kept.
+    """
+
+    def __init__(self, plan, path='./', config=None, cache_dir=None, keep=False):
+        self.path = path
+        self.config = config
+        self.cache_dir = cache_dir
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pangu-session')
+        hour_steps = plan.step_list if keep else tuple(s.hour_step for s in plan.steps[:1])
+        self._futures = {hour_step: self._executor.submit(load_model_session, hour_step, path, config, cache_dir)
+                         for hour_step in hour_steps}
+
+    def __getitem__(self, hour_step):
+        future = self._futures.get(hour_step) if self.keep else self._futures.pop(hour_step, None)
+        if future is None:
+            return load_model_session(hour_step, self.path, self.config, self.cache_dir)
+        return future.result()
+
+    def close(self):
+        """Drop the sessions not asked for, after they are loaded"""
+        self._executor.shutdown(wait=True)
+        self._futures.clear()
+
+
+def run_pipeline(inittime, d1d_dir, input_dir, output_dir, model_path, session_config=None, model_cache=None,
+                 decompress_workers=1, decode_workers=1, regrid_batch=None, archive=('netcdf',), **run_kwargs):
+    """Convert the D1D file of `inittime` and run its forecast in one process, without intermediate files
+
+    The D1D file is decompressed, decoded and regridded (see `d1d_to_pangu.convert`) while the session
+    of the first step loads, then the regridded arrays are the initial state of `run_model` straight
+    from memory. The input files of `archive` formats (see `d1d_to_pangu.write_inputs`) are written
+    into `input_dir` in background during the forecast, both take `writer.HDF5_LOCK` around their HDF5
+    calls, so the archive and the outputs are never written by the HDF5 library at once. The
+    decompressed GRIB file and its index are kept in `input_dir` as by `d1d_to_pangu`.
+
+    Parameters
+    ----------
+    inittime: datetime, initial time
+    d1d_dir: str, directory of the bz2 compressed D1D files
+    input_dir: str, directory of the input files
+    output_dir: str, directory of the forecast outputs
+    model_path: str, directory of the onnx models
+    archive: tuple of str, input formats written in background, 'netcdf' and/or 'raw'
+    run_kwargs: keyword arguments of `run_model`
+    """
+    plan = run_kwargs.pop('plan', None) or plan_forecast(default_lead_times())
+    sessions = SessionPrefetcher(plan, model_path, session_config, model_cache, keep=plan.order == 'depth-first')
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pangu-archive')
+    archived = None
+    try:
+        with Timer.labelled(inittime=f'{inittime:%Y%m%d%H}'):
+            with Timer(name='pipeline_convert', logger=logger.info):
+                fields, source = convert(inittime, d1d_dir, input_dir, decompress_workers, 'eccodes',
+                                         decode_workers, regrid_batch)
+        if archive:
+            archived = executor.submit(write_inputs, inittime, fields, input_dir, archive, source)
+        run_model(inittime, input_dir, output_dir, model_path, session_config=session_config,
+                  model_cache=model_cache, sessions=sessions, plan=plan, initial_state=input_state(fields),
+                  **run_kwargs)
+    finally:
+        executor.shutdown(wait=True)
+        sessions.close()
+    if archived is not None:
+        # raise the error of the archive, if any
+        archived.result()
+
+
+def main_():
+    example_text = """Example:
+     python pipeline.py -r --model-path /data/pangu/models"""
+
+    parser = argparse.ArgumentParser(description='Convert D1D and forecast in one process',
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_time_arguments(parser)
+    add_forecast_arguments(parser)
+    parser.add_argument('--d1d-dir', type=str,
+                        help='path to d1d field', default='/media/behz/nafp/ECMF-ORIG')
+    parser.add_argument('--decompress-workers', type=int,
+                        help='number of processes decompressing the bz2 file, by lbzip2/pbzip2 if installed',
+                        default=1)
+    parser.add_argument('--decode-workers', type=int,
+                        help='number of threads decoding GRIB messages', default=1)
+    parser.add_argument('--regrid-batch', type=int,
+                        help='number of fields regridded at a time, all fields at once by default', default=None)
+    parser.add_argument('--archive', type=str, choices=('netcdf', 'raw', 'both', 'none'),
+                        help='input files written in background for the archive', default='netcdf')
+
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+    logzero.loglevel(args.loglevel)
+    session_config, model_cache = session_options(parser, args)
+    plan, run_kwargs = forecast_options(parser, args)
+    archive = {'both': ('netcdf', 'raw'), 'none': ()}.get(args.archive, (args.archive,))
+    inittimes = parse_inittimes(args)
+    logger.debug(args)
+
+    for it in inittimes:
+        try:
+            run_pipeline(it, args.d1d_dir, args.input_dir, args.output_dir, args.model_path, session_config,
+                         model_cache, args.decompress_workers, args.decode_workers, args.regrid_batch, archive,
+                         **run_kwargs)
+        except Exception as e:
+            logger.exception(e)
+            continue
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 16:20
+# @Last Modified by: wqshen
+
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+
+STEP_LIST = (24, 6, 3, 1)
+ORDERS = ('by-model', 'depth-first')
+
+
+@dataclass
+class Step:
+    """A forecast step running the `hour_step` model on the state of `parent` to get the state of `fh`"""
+    fh: int
+    hour_step: int
+    parent: int
+    output: bool = True
+
+
+@dataclass
+class ForecastPlan:
+    """Forecast steps in execution order, built by `plan_forecast`
+
+    Steps of intermediate forecast hours which are not requested have `output` False,
+    their states are kept in memory and never written.
+    """
+    steps: List[Step]
+    order: str = 'by-model'
+    step_list: Tuple[int, ...] = STEP_LIST
+    _children: Dict[int, List[int]] = field(default_factory=dict, init=False, repr=False)
+
+    @property
+    def schedule(self):
+        """Steps as (hour_step, fh) in execution order"""
+        return [(s.hour_step, s.fh) for s in self.steps]
+
+    @property
+    def outputs(self):
+        return {s.fh for s in self.steps if s.output}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def peak_states(self, max_states=None):
+        """Maximum number of states held in memory while running the plan"""
+        return self.state_usage(max_states)[0]
+
+    def state_usage(self, max_states=None):
+        """Peak number of states held in memory and number of states evicted beyond `max_states`
+
+        As in `pangu.StateStore`, a state is evicted when `max_states` are held already,
+        except the states of intermediate steps which are not written.
+        """
+        consumers = {}
+        for s in self.steps:
+            consumers[s.parent] = consumers.get(s.parent, 0) + 1
+        live, evicted, peak = {0}, 0, 1
+        for s in self.steps:
+            consumers[s.parent] -= 1
+            if consumers[s.parent] == 0:
+                live.discard(s.parent)
+            if consumers.get(s.fh, 0) > 0:
+                if max_states is not None and len(live) >= max_states and s.output:
+                    evicted += 1
+                else:
+                    live.add(s.fh)
+            peak = max(peak, len(live))
+        return peak, evicted
+
+    def model_switches(self):
+        """Number of times the step model changes between consecutive steps"""
+        return sum(a.hour_step != b.hour_step for a, b in zip(self.steps[:-1], self.steps[1:]))
+
+    def exclude(self, done: Set[int]):
+        """Plan without the steps whose output is done
+
+        Intermediate steps are kept only when a remaining step still depends on them,
+        a done parent is the cold start state read back from its output.
+        """
+        by_fh = {s.fh: s for s in self.steps}
+        needed = set()
+        for s in self.steps:
+            if not s.output or s.fh in done:
+                continue
+            fh = s.fh
+            while fh != 0 and fh not in needed and (fh == s.fh or fh not in done):
+                needed.add(fh)
+                fh = by_fh[fh].parent
+        return ForecastPlan([s for s in self.steps if s.fh in needed], self.order, self.step_list)
+
+    def describe(self, step_seconds=None, state_bytes=None, max_states=None, spill=True):
+        """Text summary of the plan with estimated cost
+
+        States evicted beyond `max_states` are spilled to disk, or read back from their outputs
+        without `spill`.
+        """
+        lines = [f"forecast plan ({self.order}): {len(self.steps)} steps, {len(self.outputs)} outputs, "
+                 f"{self.model_switches()} model switches"]
+        for hour_step in self.step_list:
+            fhs = [s.fh for s in self.steps if s.hour_step == hour_step]
+            if fhs:
+                lines.append(f"  {hour_step:>2}h model: {len(fhs):>3} steps, fh {_ranges(fhs)}")
+        peak, evicted = self.state_usage(max_states)
+        limit = f", max_states={max_states}" if max_states is not None else ''
+        if state_bytes is not None:
+            lines.append(f"  peak states in memory: {peak} ({peak * state_bytes / 2 ** 30:0.1f} GB{limit})")
+        else:
+            lines.append(f"  peak states in memory: {peak}{limit}")
+        if evicted:
+            where = 'spilled to disk' if spill else 'read back from their outputs'
+            size = f" ({evicted * state_bytes / 2 ** 30:0.1f} GB)" if state_bytes is not None else ''
+            lines.append(f"  states evicted: {evicted}{size}, {where}")
+        if step_seconds is not None:
+            lines.append(f"  estimated inference time: {len(self.steps) * step_seconds:0.0f} seconds")
+        hidden = sorted(s.fh for s in self.steps if not s.output)
+        if hidden:
+            lines.append(f"  intermediate steps not written: fh {_ranges(hidden)}")
+        return '\n'.join(lines)
+
+
+def decompose(fh, step_list=STEP_LIST):
+    """Fewest steps of the models summing to `fh`, larger steps first
+
+    Fewer steps accumulate less forecast error, among decompositions of the same length the one
+    with larger steps is preferred, e.g. 47 = 24 + 6 + 6 + 6 + 3 + 1 + 1.
+    """
+    steps = sorted(step_list, reverse=True)
+    best: List[Optional[Tuple[int, ...]]] = [()] + [None] * fh
+    for h in range(1, fh + 1):
+        for step in steps:
+            if step <= h and best[h - step] is not None:
+                candidate = tuple(sorted(best[h - step] + (step,), reverse=True))
+                if best[h] is None or len(candidate) < len(best[h]) or \
+                        (len(candidate) == len(best[h]) and candidate > best[h]):
+                    best[h] = candidate
+    if best[fh] is None:
+        raise ValueError(f"forecast hour {fh} can not be reached by steps {step_list}")
+    return best[fh]
+
+
+def plan_forecast(lead_times, step_list=STEP_LIST, order='by-model'):
+    """Build the forecast steps of the requested lead times
+
+    Every lead time is reached by its fewest steps (see `decompose`), the parent of a forecast hour
+    is reached by the same steps without its smallest one, so the paths of all lead times form a tree
+    rooted at the initial state. Only the forecast hours on these paths are computed.
+
+    Parameters
+    ----------
+    lead_times: iterable of int, forecast hours to be written
+    step_list: tuple of int, hour steps of the available models
+    order: str
+        by-model runs the larger step models first, each model is used once;
+        depth-first walks the tree keeping the fewest states alive, it switches models often
+        and needs all step models loaded
+
+    Returns
+    -------
+    (ForecastPlan)
+    """
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}")
+    lead_times = sorted(set(lead_times))
+    nodes = {}
+    for fh in lead_times:
+        path = decompose(fh, step_list)
+        h = 0
+        for step in path:
+            h += step
+            if h not in nodes:
+                nodes[h] = Step(h, step, h - step, output=False)
+        nodes[fh].output = True
+
+    if order == 'by-model':
+        rank = {hour_step: i for i, hour_step in enumerate(sorted(step_list, reverse=True))}
+        steps = sorted(nodes.values(), key=lambda s: (rank[s.hour_step], s.fh))
+        return ForecastPlan(steps, order, tuple(step_list))
+
+    children = {}
+    for s in nodes.values():
+        children.setdefault(s.parent, []).append(s.fh)
+
+    # Sethi-Ullman order: a parent is held while all but its last child run,
+    # so the child subtree needing the most states goes last
+    need = {}
+    for fh in sorted(nodes, reverse=True):
+        kids = sorted(children.get(fh, []), key=lambda c: need[c])
+        children[fh] = kids
+        need[fh] = max([need[c] + 1 for c in kids[:-1]] + [need[kids[-1]]] if kids else [1])
+    roots = sorted(children.get(0, []), key=lambda c: need[c])
+    steps, stack = [], list(reversed(roots))
+    while stack:
+        fh = stack.pop()
+        steps.append(nodes[fh])
+        stack.extend(reversed(children.get(fh, [])))
+    return ForecastPlan(steps, order, tuple(step_list))
+
+
+def default_lead_times(fh_max=360, fh_max_hourly=84, step=3):
+    """Lead times of the operational run, hourly to `fh_max_hourly` and every `step` hours to `fh_max`"""
+    return sorted(set(range(1, fh_max_hourly + 1)) | set(range(step, fh_max + 1, step)))
+
+
+def parse_lead_times(text):
+    """Parse lead times like `1-84,87-360/3` into a sorted list of forecast hours"""
+    lead_times = set()
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        span, _, step = item.partition('/')
+        start, _, end = span.partition('-')
+        start = int(start)
+        end = int(end) if end else start
+        lead_times.update(range(start, end + 1, int(step) if step else 1))
+    if not lead_times or min(lead_times) < 1:
+        raise ValueError(f"invalid lead times {text}")
+    return sorted(lead_times)
+
+
+def _ranges(fhs):
+    fhs = sorted(fhs)
+    text, start, prev, step = [], fhs[0], fhs[0], None
+    for fh in fhs[1:] + [None]:
+        if fh is not None and (step is None or fh - prev == step) and (step is not None or fh - prev > 0):
+            step = fh - prev if step is None else step
+            prev = fh
+            continue
+        text.append(f'{start}' if start == prev else f'{start}-{prev}' + (f'/{step}' if step != 1 else ''))
+        start, prev, step = fh, fh, None
+    return ','.join(text)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 21:40
+# @Last Modified by: wqshen
+
+
+import os
+import json
+import numpy as np
+from logzero import logger
+from writer import LEVELS, HDF5_LOCK
+
+
+UPPER_VARS = ('z', 'q', 't', 'u', 'v')
+SURFACE_VARS = ('msl', 'u10', 'v10', 't2m')
+GRAVITY = 9.80665
+# raw input files: the arrays fed to the models as .npy and a json sidecar written last
+RAW_FILES = ('input_upper.npy', 'input_surface.npy')
+RAW_META = 'pangu_input.json'
+
+
+def state_buffers(pool=None):
+    """Empty (upper, surface) float32 arrays of a state, acquired from `pool` if it is given"""
+    if pool is not None:
+        return pool.acquire()
+    return np.empty((5, 13, 721, 1440), dtype='f4'), np.empty((4, 721, 1440), dtype='f4')
+
+
+def read_direct(path, upper, surface):
+    """Read a state from a NetCDF4 (HDF5) file straight into the `upper` and `surface` arrays
+
+    Both the input files of `d1d_to_pangu` (z on isobaricInhPa) and the forecast outputs (gh on level,
+    packed or not) are read. Each variable is decoded by HDF5 into its slice of the arrays, geopotential
+    height and packed integers are scaled in place, so no intermediate array of a variable is created.
+
+    Returns
+    -------
+    (bool), False if h5py is not installed, the file is not HDF5 or its layout is not the expected one,
+    nothing has been read then
+    """
+    try:
+        import h5py
+    except ImportError:
+        return False
+
+    # h5py may share the HDF5 library of netCDF4, the writer threads hold the same lock
+    with HDF5_LOCK:
+        if not h5py.is_hdf5(path):
+            return False
+        with h5py.File(path, 'r') as f:
+            level = next((f[n][()] for n in ('level', 'isobaricInhPa') if n in f), None)
+            lat = next((f[n] for n in ('lat', 'latitude') if n in f), None)
+            height = 'gh' if 'gh' in f else 'z'
+            names = (height,) + UPPER_VARS[1:] + SURFACE_VARS
+            if level is None or lat is None or list(level) != list(LEVELS) or lat[0] < lat[-1] or \
+                    any(n not in f for n in names):
+                return False
+            targets = list(upper) + list(surface)
+            if any(f[n].shape[-2:] != (721, 1440) for n in names):
+                return False
+            for name, d in zip(names, targets):
+                var = f[name]
+                # leading time dimension of the forecast outputs
+                source = np.s_[(0,) * (var.ndim - d.ndim)] if var.ndim > d.ndim else None
+                var.read_direct(d, source_sel=source)
+                _decode(d, var.attrs)
+            if height == 'gh':
+                upper[0] *= GRAVITY
+    return True
+
+
+def _decode(d, attrs):
+    """Apply the CF packing attributes in place, fill values become NaN"""
+    scale = attrs.get('scale_factor')
+    offset = attrs.get('add_offset')
+    fill = attrs.get('_FillValue')
+    mask = None
+    if fill is not None:
+        fill = np.float32(np.ravel(fill)[0])
+        if not np.isnan(fill):
+            mask = d == fill
+    if scale is not None:
+        d *= np.float32(np.ravel(scale)[0])
+    if offset is not None:
+        d += np.float32(np.ravel(offset)[0])
+    if mask is not None and mask.any():
+        d[mask] = np.nan
+
+
+def read_dataset(ds, upper, surface):
+    """Copy a state from an xarray dataset into the `upper` and `surface` arrays, variable by variable"""
+    height = 'z' if 'z' in ds else 'gh'
+    for name, d in zip((height,) + UPPER_VARS[1:] + SURFACE_VARS, list(upper) + list(surface)):
+        d[...] = ds[name].values.reshape(d.shape)
+    if height == 'gh':
+        upper[0] *= GRAVITY
+
+
+def write_raw(directory, upper, surface, **meta):
+    """Write a state as raw input files in `directory`, contiguous float32 .npy of the model input layouts
+
+    The arrays are written under temporary names and renamed, then the json sidecar holding `meta`,
+    the variables, levels and shapes is written, so a sidecar is only found beside complete arrays.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, d in zip(RAW_FILES, (upper, surface)):
+        path = os.path.join(directory, name)
+        with open(f'{path}.part', 'wb') as f:
+            np.save(f, np.ascontiguousarray(d, dtype='f4'))
+        os.replace(f'{path}.part', path)
+    meta = dict(meta, upper=list(UPPER_VARS), surface=list(SURFACE_VARS), levels=[int(l) for l in LEVELS],
+                shapes=[list(upper.shape), list(surface.shape)], files=list(RAW_FILES))
+    path = os.path.join(directory, RAW_META)
+    with open(f'{path}.part', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(f'{path}.part', path)
+
+
+def read_raw(directory):
+    """Memory-map the raw input files of `directory`, see `write_raw`
+
+    Returns
+    -------
+    (upper, surface), read-only memory-mapped arrays paged in as the models read them, or None if the
+    sidecar is missing or the files do not hold the model input layouts
+    """
+    path = os.path.join(directory, RAW_META)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+        if meta['levels'] != [int(l) for l in LEVELS] or meta['upper'] != list(UPPER_VARS) or \
+                meta['surface'] != list(SURFACE_VARS):
+            raise ValueError("unexpected variables or levels")
+        arrays = tuple(np.load(os.path.join(directory, name), mmap_mode='r') for name in RAW_FILES)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"failed to read raw input {directory}: {e}")
+        return None
+    if arrays[0].shape != (5, 13, 721, 1440) or arrays[1].shape != (4, 721, 1440) or \
+            any(d.dtype != np.float32 or not d.flags.c_contiguous for d in arrays):
+        logger.warning(f"raw input {directory} does not hold the model input layouts")
+        return None
+    return arrays
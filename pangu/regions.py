@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 18:05
+# @Last Modified by: wqshen
+
+
+import json
+import numpy as np
+from dataclasses import dataclass
+
+
+# (lon_min, lon_max, lat_min, lat_max) of the regions read by the products
+REGIONS = {'china': (95, 145, 10, 50),  # extent of ProductPlot
+           'zhejiang': (115, 132, 20, 36),  # Zhejiang and its sea zones
+           }
+RESOLUTION = 0.25
+
+
+@dataclass(frozen=True)
+class Region:
+    """A lat/lon box of the 0.25 degree global grid (lat 90 to -90, lon 0 to 359.75)"""
+    name: str
+    lon_min: float
+    lon_max: float
+    lat_min: float
+    lat_max: float
+
+    def __post_init__(self) -> None:
+        if not (0 <= self.lon_min < self.lon_max <= 359.75 and -90 <= self.lat_min < self.lat_max <= 90):
+            raise ValueError(f"invalid region {self}, longitudes must be within 0-359.75 without crossing 0")
+
+    @property
+    def lat_slice(self):
+        return slice(int(np.floor((90 - self.lat_max) / RESOLUTION)),
+                     int(np.ceil((90 - self.lat_min) / RESOLUTION)) + 1)
+
+    @property
+    def lon_slice(self):
+        return slice(int(np.floor(self.lon_min / RESOLUTION)), int(np.ceil(self.lon_max / RESOLUTION)) + 1)
+
+    @property
+    def lats(self):
+        return np.linspace(90, -90, 721)[self.lat_slice]
+
+    @property
+    def lons(self):
+        return np.linspace(0, 359.75, 1440)[self.lon_slice]
+
+    def subset(self, d):
+        """View of the region of a field whose last two dimensions are lat and lon"""
+        return d[..., self.lat_slice, self.lon_slice]
+
+
+def load_regions(names, config=None):
+    """Regions of `names`, boxes are looked up in the json `config` ({name: [lon_min, lon_max, lat_min, lat_max]})
+    then in REGIONS"""
+    boxes = dict(REGIONS)
+    if config is not None:
+        with open(config) as f:
+            boxes.update(json.load(f))
+    unknown = [n for n in names if n not in boxes]
+    if unknown:
+        raise ValueError(f"unknown regions {unknown}, available are {sorted(boxes)}")
+    return [Region(n, *boxes[n]) for n in names]
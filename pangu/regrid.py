@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 22:50
+# @Last Modified by: wqshen
+
+
+import os
+import hashlib
+import numpy as np
+from logzero import logger
+
+
+TARGET_LATS = np.linspace(90, -90, 721)
+TARGET_LONS = np.linspace(0, 359.75, 1440)
+
+
+def axis_weights(source, target):
+    """Indices and weights of the linear interpolation of `target` points between `source` points
+
+    Returns
+    -------
+    (i0, i1, w, valid), a target value is `(1 - w) * f[i0] + w * f[i1]`, points out of the range of
+    `source` are not valid (NaN like `xarray.interp` without extrapolation)
+    """
+    source = np.asarray(source, dtype='f8')
+    target = np.asarray(target, dtype='f8')
+    descending = source[0] > source[-1]
+    x = source[::-1] if descending else source
+    valid = (target >= x[0]) & (target <= x[-1])
+    i1 = np.clip(np.searchsorted(x, target, side='right'), 1, len(x) - 1)
+    i0 = i1 - 1
+    w = np.clip((target - x[i0]) / (x[i1] - x[i0]), 0, 1)
+    if descending:
+        i0, i1 = len(x) - 1 - i0, len(x) - 1 - i1
+    return i0, i1, w.astype('f4'), valid
+
+
+class Regridder:
+    """Bilinear interpolation from a regular lat/lon grid to another, with weights computed once
+
+    The interpolation is separable, fields are interpolated along latitude then along longitude by
+    gathers of precomputed indices and multiplications by precomputed weights, all fields of a batch
+    at once. Weights are cached as npz in `cache_dir`, keyed by the source and target grids.
+
+    Examples
+    --------
+        >>>regridder = Regridder.load(lats, lons, cache_dir='/data/pangu/input')
+        >>>out = regridder(fields)  # (..., nlat, nlon) to (..., 721, 1440)
+    """
+
+    def __init__(self, lat_weights, lon_weights):
+        self.lat_weights = lat_weights
+        self.lon_weights = lon_weights
+        self.shape = (len(lat_weights[0]), len(lon_weights[0]))
+
+    @classmethod
+    def build(cls, lats, lons, target_lats=TARGET_LATS, target_lons=TARGET_LONS):
+        return cls(axis_weights(lats, target_lats), axis_weights(lons, target_lons))
+
+    @classmethod
+    def load(cls, lats, lons, target_lats=TARGET_LATS, target_lons=TARGET_LONS, cache_dir=None):
+        """Regridder of the weights cached in `cache_dir`, computed and cached when missing"""
+        if cache_dir is None:
+            return cls.build(lats, lons, target_lats, target_lons)
+        key = hashlib.sha256(b''.join(np.asarray(a, dtype='f8').tobytes()
+                                      for a in (lats, lons, target_lats, target_lons))).hexdigest()[:16]
+        path = os.path.join(cache_dir, f'regrid.{key}.npz')
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as f:
+                    return cls(tuple(f[f'lat_{n}'] for n in ('i0', 'i1', 'w', 'valid')),
+                               tuple(f[f'lon_{n}'] for n in ('i0', 'i1', 'w', 'valid')))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"failed to read regrid weights {path}: {e}")
+        regridder = cls.build(lats, lons, target_lats, target_lons)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            arrays = {f'{axis}_{n}': a for axis, weights in (('lat', regridder.lat_weights),
+                                                             ('lon', regridder.lon_weights))
+                      for n, a in zip(('i0', 'i1', 'w', 'valid'), weights)}
+            # np.savez appends .npz to names without it
+            np.savez(f'{path}.part.npz', **arrays)
+            os.replace(f'{path}.part.npz', path)
+            logger.info(f"regrid weights cached to {path}")
+        except OSError as e:
+            logger.warning(f"failed to cache regrid weights {path}: {e}")
+        return regridder
+
+    def __call__(self, fields, out=None, batch=None):
+        """Interpolate `fields` (..., nlat, nlon) into `out` (..., 721, 1440), `batch` fields at a time"""
+        (yi0, yi1, wy, vy), (xi0, xi1, wx, vx) = self.lat_weights, self.lon_weights
+        lead = fields.shape[:-2]
+        src = fields.reshape((-1,) + fields.shape[-2:])
+        if out is None:
+            out = np.empty(lead + self.shape, dtype='f4')
+        dst = out.reshape((-1,) + self.shape)
+        n = len(src)
+        batch = min(batch or n, n)
+        lower = np.empty((batch, self.shape[0], src.shape[-1]), dtype='f4')
+        upper = np.empty_like(lower)
+        right = np.empty((batch,) + self.shape, dtype='f4')
+        wy0, wy1 = (1 - wy)[:, None], wy[:, None]
+        wx0, wx1 = 1 - wx, wx
+        for start in range(0, n, batch):
+            end = min(start + batch, n)
+            b = end - start
+            np.take(src[start:end], yi0, axis=1, out=lower[:b])
+            np.take(src[start:end], yi1, axis=1, out=upper[:b])
+            lower[:b] *= wy0
+            upper[:b] *= wy1
+            lower[:b] += upper[:b]
+            np.take(lower[:b], xi0, axis=2, out=dst[start:end])
+            np.take(lower[:b], xi1, axis=2, out=right[:b])
+            dst[start:end] *= wx0
+            right[:b] *= wx1
+            dst[start:end] += right[:b]
+        if not vy.all():
+            dst[:, ~vy, :] = np.nan
+        if not vx.all():
+            dst[:, :, ~vx] = np.nan
+        return out
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 13:05
+# @Last Modified by: wqshen
+
+
+import os
+import json
+import time
+import hashlib
+import itertools
+import numpy as np
+import onnxruntime as ort
+from dataclasses import dataclass, asdict, fields, replace
+from typing import Optional
+from logzero import logger
+
+
+EXECUTION_MODES = {'sequential': ort.ExecutionMode.ORT_SEQUENTIAL,
+                   'parallel': ort.ExecutionMode.ORT_PARALLEL}
+GRAPH_OPTIMIZATION_LEVELS = {'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                             'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                             'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                             'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+PROVIDERS = ('cuda', 'cpu')
+
+
+@dataclass
+class SessionConfig:
+    """Execution provider, threading and memory options of the ONNX Runtime sessions
+
+    The defaults are the CUDA settings used in operation, `SessionConfig.cpu()` is the profile
+    of CPU-only nodes. Configs are saved and loaded as json, e.g. the result of `autotune`.
+    """
+    provider: str = 'cuda'
+    intra_op_num_threads: int = 1
+    inter_op_num_threads: int = 0
+    execution_mode: str = 'sequential'
+    graph_optimization_level: str = 'all'
+    enable_cpu_mem_arena: bool = False
+    enable_mem_pattern: bool = False
+    enable_mem_reuse: bool = False
+
+    def __post_init__(self) -> None:
+        if self.provider not in PROVIDERS:
+            raise ValueError(f"provider must be one of {PROVIDERS}")
+        if self.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"execution_mode must be one of {tuple(EXECUTION_MODES)}")
+        if self.graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"graph_optimization_level must be one of {tuple(GRAPH_OPTIMIZATION_LEVELS)}")
+
+    @classmethod
+    def cpu(cls, **kwargs) -> 'SessionConfig':
+        """CPU profile, all logical cores (`os.cpu_count`) for the operators and the memory arena enabled"""
+        config = dict(provider='cpu', intra_op_num_threads=os.cpu_count(), enable_cpu_mem_arena=True,
+                      enable_mem_pattern=True, enable_mem_reuse=True)
+        config.update(kwargs)
+        return cls(**config)
+
+    @classmethod
+    def load(cls, path) -> 'SessionConfig':
+        with open(path) as f:
+            config = json.load(f)
+        names = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in config.items() if k in names})
+
+    def save(self, path, **extra) -> None:
+        with open(path, 'w') as f:
+            json.dump({**asdict(self), **extra}, f, indent=2)
+
+    def update(self, **kwargs) -> 'SessionConfig':
+        """New config with the options which are not None in kwargs"""
+        return replace(self, **{k: v for k, v in kwargs.items() if v is not None})
+
+    def session_options(self) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        options.enable_cpu_mem_arena = self.enable_cpu_mem_arena
+        options.enable_mem_pattern = self.enable_mem_pattern
+        options.enable_mem_reuse = self.enable_mem_reuse
+        # Increase the number for faster inference and more memory consumption
+        options.intra_op_num_threads = self.intra_op_num_threads
+        options.inter_op_num_threads = self.inter_op_num_threads
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[self.graph_optimization_level]
+        return options
+
+    def providers(self) -> list:
+        if self.provider == 'cpu':
+            return ['CPUExecutionProvider']
+        # Set the behavier of cuda provider
+        cuda_provider_options = {'arena_extend_strategy': 'kSameAsRequested', }
+        return [('CUDAExecutionProvider', cuda_provider_options)]
+
+
+def file_hash(path, cache_dir=None):
+    """sha256 of a file, memoized in `cache_dir`/hashes.json by path, size and modification time"""
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    path_hashes = os.path.join(cache_dir, 'hashes.json') if cache_dir is not None else None
+    hashes = {}
+    if path_hashes is not None and os.path.isfile(path_hashes):
+        with open(path_hashes) as f:
+            hashes = json.load(f)
+        if key in hashes:
+            return hashes[key]
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            sha256.update(block)
+    if path_hashes is not None:
+        hashes[key] = sha256.hexdigest()
+        tmp = f'{path_hashes}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(hashes, f, indent=2)
+        os.replace(tmp, path_hashes)
+    return sha256.hexdigest()
+
+
+def cached_optimization_level(config: SessionConfig):
+    """Graph optimization level of the cached graph, at most 'extended'
+
+    The layout optimizations of 'all' depend on the hardware, a graph serialized with them may not
+    run well on other nodes sharing the cache, so they are applied when the cached graph is loaded.
+    """
+    return 'extended' if config.graph_optimization_level == 'all' else config.graph_optimization_level
+
+
+def optimized_model_path(path_model, config: SessionConfig, cache_dir):
+    """Path of the cached optimized graph of a model, keyed by model hash, ORT version, provider and
+    optimization level
+
+    Threading and memory options do not change the optimized graph, so they share a cached graph.
+    """
+    key = json.dumps({'model': file_hash(path_model, cache_dir), 'ort': ort.__version__,
+                      'provider': config.provider, 'graph_optimization_level': cached_optimization_level(config)},
+                     sort_keys=True)
+    name = os.path.splitext(os.path.basename(path_model))[0]
+    return os.path.join(cache_dir, f'{name}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.ort.onnx')
+
+
+def create_session(path_model, config: Optional[SessionConfig] = None, cache_dir=None):
+    """Create an inference session, reusing the optimized graph cached in `cache_dir`
+
+    On a cache miss the graph optimized by ORT (at most at the 'extended' level, see
+    `cached_optimization_level`) is serialized into the cache. On a hit the optimized graph is loaded
+    with graph optimizations disabled, so they are not run again, except the hardware specific ones
+    of the 'all' level.
+    """
+    config = config or SessionConfig()
+    if cache_dir is None or config.graph_optimization_level == 'disable':
+        return ort.InferenceSession(path_model, sess_options=config.session_options(),
+                                    providers=config.providers())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path_optimized = optimized_model_path(path_model, config, cache_dir)
+    except OSError as e:
+        logger.warning(f"optimized model cache {cache_dir} is not available: {e}")
+        return ort.InferenceSession(path_model, sess_options=config.session_options(),
+                                    providers=config.providers())
+
+    level = cached_optimization_level(config)
+    if not os.path.isfile(path_optimized):
+        options = replace(config, graph_optimization_level=level).session_options()
+        # ORT serializes to the onnx format according to the extension
+        path_tmp = f'{os.path.splitext(path_optimized)[0]}.{os.getpid()}.tmp.onnx'
+        options.optimized_model_filepath = path_tmp
+        session = ort.InferenceSession(path_model, sess_options=options, providers=config.providers())
+        if not os.path.isfile(path_tmp):
+            return session
+        os.replace(path_tmp, path_optimized)
+        logger.info(f"optimized model cached to {path_optimized}")
+        if level == config.graph_optimization_level:
+            return session
+        # loaded again below, with the optimizations of 'all'
+        del session
+
+    logger.info(f"load optimized model {path_optimized}")
+    load_level = 'all' if config.graph_optimization_level == 'all' else 'disable'
+    options = replace(config, graph_optimization_level=load_level).session_options()
+    return ort.InferenceSession(path_optimized, sess_options=options, providers=config.providers())
+
+
+def synthetic_input(seed=0):
+    """Random input of the pangu models, the values do not matter for timing"""
+    rng = np.random.default_rng(seed)
+    input = rng.standard_normal((5, 13, 721, 1440), dtype='f4')
+    input_surface = rng.standard_normal((4, 721, 1440), dtype='f4')
+    return input, input_surface
+
+
+def autotune(path_model, base: Optional[SessionConfig] = None, repeat=3, candidates=None):
+    """Benchmark combinations of session options on synthetic input and return the fastest one
+
+    Parameters
+    ----------
+    path_model: str, path of the onnx model to be benchmarked
+    base: SessionConfig, options not tuned, the CPU profile by default
+    repeat: int, number of timed runs after a warm up run, the median is compared
+    candidates: dict, option name to the list of values to be tried, all combinations are run
+
+    Returns
+    -------
+    (SessionConfig, float), the fastest config and its median inference time in seconds
+    """
+    base = base or SessionConfig.cpu()
+    if candidates is None:
+        ncpu = os.cpu_count()
+        candidates = {'intra_op_num_threads': sorted({max(ncpu // 4, 1), max(ncpu // 2, 1), ncpu}),
+                      'inter_op_num_threads': [0, 2],
+                      'execution_mode': list(EXECUTION_MODES),
+                      'enable_cpu_mem_arena': [True, False]}
+    input, input_surface = synthetic_input()
+    best, best_time = None, float('inf')
+    names = list(candidates)
+    for values in itertools.product(*[candidates[n] for n in names]):
+        config = replace(base, **dict(zip(names, values)))
+        try:
+            session = ort.InferenceSession(path_model, sess_options=config.session_options(),
+                                           providers=config.providers())
+            session.run(None, {'input': input, 'input_surface': input_surface})
+            elapsed = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                session.run(None, {'input': input, 'input_surface': input_surface})
+                elapsed.append(time.perf_counter() - start)
+            del session
+        except Exception as e:
+            logger.warning(f"autotune {dict(zip(names, values))} failed: {e}")
+            continue
+        t = float(np.median(elapsed))
+        logger.info(f"autotune {dict(zip(names, values))}: {t:0.4f} seconds")
+        if t < best_time:
+            best, best_time = config, t
+    if best is None:
+        raise RuntimeError("all autotune candidates failed")
+    return best, best_time
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 19:00
+# @Last Modified by: wqshen
+
+
+import os
+import csv
+import numpy as np
+import xarray as xr
+from datetime import timedelta
+from logzero import logger
+from writer import LEVELS, ATTRS, COORD_ATTRS
+
+
+RESOLUTION = 0.25
+METHODS = ('nearest', 'bilinear')
+
+
+def read_stations(path):
+    """Stations of a csv file with columns name, lon, lat"""
+    with open(path, encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    return [r['name'] for r in rows], np.array([float(r['lon']) for r in rows]), \
+        np.array([float(r['lat']) for r in rows])
+
+
+class StationSampler:
+    """Sample fields of the 0.25 degree global grid at stations
+
+    Indices and weights are computed once, sampling a field is a gather of 1 (nearest) or
+    4 (bilinear) points per station over all leading dimensions at once.
+
+    Parameters
+    ----------
+    lons: array of station longitudes, degrees east
+    lats: array of station latitudes, degrees north
+    method: str, nearest or bilinear
+    """
+
+    def __init__(self, lons, lats, method='bilinear'):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}")
+        self.method = method
+        x = np.mod(np.asarray(lons, dtype='f8'), 360) / RESOLUTION
+        y = np.clip((90 - np.asarray(lats, dtype='f8')) / RESOLUTION, 0, 720)
+        if method == 'nearest':
+            self.iy = np.rint(y).astype(int)
+            self.ix = np.rint(x).astype(int) % 1440
+            return
+        iy0 = np.minimum(np.floor(y).astype(int), 719)
+        ix0 = np.floor(x).astype(int) % 1440
+        wy, wx = y - iy0, x - np.floor(x)
+        self.iy = np.stack([iy0, iy0, iy0 + 1, iy0 + 1])
+        self.ix = np.stack([ix0, (ix0 + 1) % 1440, ix0, (ix0 + 1) % 1440])
+        self.weights = np.stack([(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx]).astype('f4')
+
+    def sample(self, d):
+        """Values of a field (..., lat, lon) at the stations, shape (..., station)"""
+        if self.method == 'nearest':
+            return d[..., self.iy, self.ix]
+        return np.einsum('...ks,ks->...s', d[..., self.iy, self.ix], self.weights)
+
+
+class StationSeries:
+    """Time series of all forecast variables at stations, accumulated step by step into one table
+
+    Examples
+    --------
+        >>>series = StationSeries('stations.csv', inittime, fhs)
+        >>>series.add(fh, output, output_surface)  # after each step
+        >>>series.write(f'{output_dir}/pangu.I{inittime:%Y%m%d%H}.stations.nc')
+    """
+
+    def __init__(self, path, inittime, fhs, method='bilinear'):
+        self.names, lons, lats = read_stations(path)
+        self.lons, self.lats = lons, lats
+        self.inittime = inittime
+        self.fhs = sorted(fhs)
+        self._index = {fh: i for i, fh in enumerate(self.fhs)}
+        self.sampler = StationSampler(lons, lats, method)
+        nt, ns = len(self.fhs), len(self.names)
+        self.upper = np.full((nt, 5, len(LEVELS), ns), np.nan, dtype='f4')
+        self.surface = np.full((nt, 4, ns), np.nan, dtype='f4')
+        # lead times sampled or loaded
+        self.completed = set()
+
+    def add(self, fh, output, output_surface):
+        i = self._index[fh]
+        self.upper[i] = self.sampler.sample(output)
+        self.surface[i] = self.sampler.sample(output_surface)
+        self.upper[i, 0] /= 9.80665
+        self.completed.add(fh)
+
+    def load(self, path):
+        """Fill the lead times already sampled in a table written before, e.g. when resuming a run"""
+        if not os.path.isfile(path):
+            return
+        with xr.open_dataset(path) as ds:
+            if list(ds['station'].values) != self.names:
+                logger.warning(f"stations of {path} differ, it is not loaded")
+                return
+            for j, fh in enumerate(ds['step'].values):
+                i = self._index.get(int(fh))
+                if i is None:
+                    continue
+                for k, name in enumerate(('gh', 'q', 't', 'u', 'v')):
+                    self.upper[i, k] = ds[name].values[j].T
+                for k, name in enumerate(('msl', 'u10', 'v10', 't2m')):
+                    self.surface[i, k] = ds[name].values[j]
+                # rows of lead times not sampled yet are NaN in the table
+                if not np.isnan(self.surface[i]).all():
+                    self.completed.add(int(fh))
+
+    def to_dataset(self):
+        times = [self.inittime + timedelta(hours=fh) for fh in self.fhs]
+        coords = {'time': times, 'step': ('time', np.array(self.fhs), {'long_name': 'lead time', 'units': 'hours'}),
+                  'level': ('level', LEVELS, COORD_ATTRS['level']), 'station': self.names,
+                  'lon': ('station', self.lons, COORD_ATTRS['lon']), 'lat': ('station', self.lats, COORD_ATTRS['lat'])}
+        data_vars = {}
+        for k, name in enumerate(('gh', 'q', 't', 'u', 'v')):
+            data_vars[name] = (('time', 'station', 'level'), self.upper[:, k].transpose(0, 2, 1), ATTRS[name])
+        for k, name in enumerate(('msl', 'u10', 'v10', 't2m')):
+            data_vars[name] = (('time', 'station'), self.surface[:, k], ATTRS[name])
+        return xr.Dataset(data_vars, coords=coords,
+                          attrs={'interpolation': self.sampler.method,
+                                 'initial_time': f'{self.inittime:%Y-%m-%d %H:%M:%S}'})
+
+    def write(self, path):
+        tmp = f'{path}.part'
+        self.to_dataset().to_netcdf(tmp)
+        os.replace(tmp, path)
@@ -4,16 +4,268 @@
 # @Last Modified by: wqshen
 
 
+import os
+import json
 import time
-from dataclasses import dataclass, field
-from typing import Callable, ClassVar, Dict, Optional
-from contextlib import ContextDecorator
+import tempfile
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import ContextDecorator, contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Callable, ClassVar, Dict, Optional, Tuple
 
 
 class TimerError(Exception):
     """A custom exception used to report errors in use of Timer class"""
 
 
+# thread-local labels and stack of running timers, see `Timer.labelled`
+_context = threading.local()
+
+
+def _quantile(samples, q):
+    """Linearly interpolated quantile of sorted samples"""
+    if not samples:
+        return None
+    pos = q * (len(samples) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(samples) - 1)
+    return samples[lo] + (samples[hi] - samples[lo]) * (pos - lo)
+
+
+class Series:
+    """Statistics of the observations of a metric with the same labels
+
+    count, sum, min and max are exact, quantiles are computed over the latest `max_samples` observations.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.samples.extend(other.samples)
+
+    def stats(self):
+        samples = sorted(self.samples)
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': _quantile(samples, 0.5), 'p95': _quantile(samples, 0.95)}
+
+
+class Metrics:
+    """Thread-safe registry of timings, keyed by name, labels and the enclosing span
+
+    Examples
+    --------
+        >>>metrics = Metrics()
+        >>>metrics.observe('pangu_inference', 12.3, {'step': '24', 'fh': '024'})
+        >>>metrics.write_json('metrics.json')
+        >>>metrics.write_prometheus('/var/lib/node_exporter/pangu.prom', prefix='pangu', keep=('step',))
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._series: Dict[Tuple[str, Tuple[Tuple[str, str], ...], Optional[str]], Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, labels=None, parent=None):
+        key = (name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items())), parent)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = Series(self.max_samples)
+            self._series[key].observe(value)
+
+    def reset(self, match=None):
+        """Remove all series, or only those with the labels of `match`"""
+        with self._lock:
+            if match is None:
+                self._series.clear()
+                return
+            for key in [k for k in self._series if _matches(k[1], match)]:
+                del self._series[key]
+
+    def aggregate(self, keep=None, match=None):
+        """Series merged over the labels not in `keep` (all labels are kept by default) and over spans
+
+        Parameters
+        ----------
+        keep: iterable of str, optional, labels which are kept
+        match: dict, optional, only the series with these labels are included
+
+        Returns
+        -------
+        (dict), (name, labels) to Series
+        """
+        merged = {}
+        with self._lock:
+            items = list(self._series.items())
+        for (name, labels, _), series in items:
+            if not _matches(labels, match):
+                continue
+            labels = tuple((k, v) for k, v in labels if keep is None or k in keep)
+            if (name, labels) not in merged:
+                merged[name, labels] = Series(self.max_samples)
+            merged[name, labels].merge(series)
+        return merged
+
+    def report(self, match=None):
+        """Statistics of every series and of every name over all its labels"""
+        with self._lock:
+            items = list(self._series.items())
+        series = [{'name': name, 'labels': dict(labels), 'parent': parent, **s.stats()}
+                  for (name, labels, parent), s in items
+                  if _matches(labels, match)]
+        totals = {name: s.stats() for (name, _), s in sorted(self.aggregate(keep=(), match=match).items())}
+        return {'series': series, 'totals': totals}
+
+    def write_json(self, path, match=None):
+        _write_atomic(path, json.dumps(self.report(match), indent=2))
+
+    def to_prometheus(self, prefix='timer', keep=None, match=None, unit='seconds',
+                      description='Elapsed time of timed stages'):
+        """Prometheus text format of the series as a summary in `unit`"""
+        metric = f'{prefix}_{unit}'
+        lines = [f'# HELP {metric} {description}', f'# TYPE {metric} summary']
+        for (name, labels), s in sorted(self.aggregate(keep, match).items()):
+            stats = s.stats()
+            label = ','.join([f'name="{name}"'] + [f'{k}="{v}"' for k, v in labels])
+            for q, key in (('0.5', 'p50'), ('0.95', 'p95')):
+                lines.append(f'{metric}{{{label},quantile="{q}"}} {stats[key]:.6f}')
+            lines.append(f'{metric}_sum{{{label}}} {stats["sum"]:.6f}')
+            lines.append(f'{metric}_count{{{label}}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='timer', keep=None, match=None, **kwargs):
+        """Write a textfile of the node exporter textfile collector, replaced atomically"""
+        _write_atomic(path, self.to_prometheus(prefix, keep, match, **kwargs))
+
+
+class MemoryTracker:
+    """Opt-in memory snapshots taken by named timers
+
+    Once enabled, every named timer records into `registry` the RSS of the process when it stops
+    (`{name}.rss`) and its change over the timer (`{name}.rss_delta`), with tracemalloc also the
+    memory traced by Python allocations (`{name}.traced`). Values are in bytes, RSS is read from /proc.
+
+    Examples
+    --------
+        >>>Timer.memory.enable(trace=True)
+        >>>Timer.memory.reset_peak()
+        >>># Do something
+        >>>Timer.memory.high_watermark(), Timer.memory.top_allocations(10)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.registry = Metrics()
+
+    def enable(self, trace=False, frames=1):
+        """Start taking snapshots, `trace` starts tracemalloc keeping `frames` frames per allocation"""
+        self.enabled = True
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.trace = self.trace or trace
+
+    def disable(self):
+        self.enabled = False
+        if self.trace:
+            tracemalloc.stop()
+            self.trace = False
+
+    def snapshot(self):
+        """Current RSS and traced memory (bytes), None when it is not available"""
+        snapshot = {'rss': _proc_status('VmRSS'), 'traced': None}
+        if self.trace and tracemalloc.is_tracing():
+            snapshot['traced'] = tracemalloc.get_traced_memory()[0]
+        return snapshot
+
+    def observe(self, name, start, labels=None, parent=None):
+        """Record the snapshot at the end of timer `name` started with the snapshot `start`"""
+        stop = self.snapshot()
+        if stop['rss'] is not None:
+            self.registry.observe(f'{name}.rss', stop['rss'], labels, parent)
+            if start is not None and start['rss'] is not None:
+                self.registry.observe(f'{name}.rss_delta', stop['rss'] - start['rss'], labels, parent)
+        if stop['traced'] is not None:
+            self.registry.observe(f'{name}.traced', stop['traced'], labels, parent)
+        return stop
+
+    def reset_peak(self):
+        """Reset the high-watermarks of RSS (Linux) and traced memory, e.g. at the start of a run"""
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def high_watermark(self):
+        """Peak RSS and traced memory (bytes) since the last `reset_peak`"""
+        hwm = {'rss': _proc_status('VmHWM'), 'traced': None}
+        if self.trace and tracemalloc.is_tracing():
+            hwm['traced'] = tracemalloc.get_traced_memory()[1]
+        return hwm
+
+    def top_allocations(self, limit=10, key='lineno'):
+        """Largest live Python allocations grouped by `key`, empty unless tracemalloc is tracing"""
+        if not (self.trace and tracemalloc.is_tracing()):
+            return []
+        stats = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]).statistics(key)
+        return [{'location': str(s.traceback), 'size': s.size, 'count': s.count} for s in stats[:limit]]
+
+
+def _proc_status(field):
+    """A memory field (bytes) of /proc/self/status, e.g. VmRSS or VmHWM"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _matches(labels, match):
+    return match is None or all(dict(labels).get(k) == str(v) for k, v in match.items())
+
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    # a unique temporary file, the same path may be written by several threads (e.g. jobs of a daemon)
+    fd, tmp = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # readable by the collectors, as files created by open
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 @dataclass
 class Timer(ContextDecorator):
     """
@@ -37,27 +289,64 @@ class Timer(ContextDecorator):
         >>>def stuff():
         >>>    # Do something
 
+    Named timers also record each elapsed time into `Timer.registry` with their labels, the labels
+    of the enclosing `Timer.labelled` blocks and the name of the enclosing timer (span) of the thread.
+
+        >>>with Timer.labelled(fh='024'):
+        >>>    with Timer(name="inference", labels={'step': '24'}):
+        >>>        # Do something
+        >>>Timer.registry.write_json('metrics.json')
+
+    With `Timer.memory.enable()`, named timers also record memory snapshots, see `MemoryTracker`.
+
     Notes
     -----
     This class is totally fetched from https://realpython.com/python-timer/
     See the details on the website, it is a step-to-step toturial.
     """
     timers: ClassVar[Dict[str, float]] = dict()
+    registry: ClassVar[Metrics] = Metrics()
+    memory: ClassVar[MemoryTracker] = MemoryTracker()
     name: Optional[str] = None
     text: str = "{name}: elapsed time: {t:0.4f} seconds"
     logger: Optional[Callable[[str], None]] = print
+    labels: Optional[Dict[str, str]] = None
     _start_time: Optional[float] = field(default=None, init=False, repr=False)
+    _parent: Optional[str] = field(default=None, init=False, repr=False)
+    _memory_start: Optional[Dict[str, Optional[int]]] = field(default=None, init=False, repr=False)
+    _lock: ClassVar[threading.Lock] = threading.Lock()
 
     def __post_init__(self) -> None:
         """Add timer to dict of timers after initialization"""
         if self.name is not None:
             self.timers.setdefault(self.name, 0)
 
+    @staticmethod
+    @contextmanager
+    def labelled(**labels):
+        """Labels of all timers stopped in the block by the current thread"""
+        previous = Timer.current_labels()
+        _context.labels = {**previous, **{k: str(v) for k, v in labels.items()}}
+        try:
+            yield
+        finally:
+            _context.labels = previous
+
+    @staticmethod
+    def current_labels():
+        """Labels of the enclosing `labelled` blocks of the current thread"""
+        return dict(getattr(_context, 'labels', {}))
+
     def start(self) -> None:
         """Start a new timer"""
         if self._start_time is not None:
             raise TimerError(f"Timer is running. Use .stop() to stop it")
 
+        stack = _context.__dict__.setdefault('spans', [])
+        self._parent = stack[-1].name if stack else None
+        stack.append(self)
+        if self.name and self.memory.enabled:
+            self._memory_start = self.memory.snapshot()
         self._start_time = time.perf_counter()
 
     def stop(self) -> float:
@@ -68,15 +357,33 @@ class Timer(ContextDecorator):
         # Calculate elapsed time
         elapsed_time = time.perf_counter() - self._start_time
         self._start_time = None
+        stack = _context.__dict__.get('spans', [])
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is self:
+                del stack[i]
+                break
 
         # Report elapsed time
         if self.logger:
             self.logger(self.text.format(name=self.name, t=elapsed_time))
         if self.name:
-            self.timers[self.name] += elapsed_time
+            with self._lock:
+                self.timers[self.name] += elapsed_time
+            labels = {**self.current_labels(), **(self.labels or {})}
+            self.registry.observe(self.name, elapsed_time, labels, self._parent)
+            if self.memory.enabled:
+                memory = self.memory.observe(self.name, self._memory_start, labels, self._parent)
+                if self.logger and memory['rss'] is not None:
+                    delta = memory['rss'] - self._memory_start['rss'] if self._memory_start else 0
+                    self.logger(f"{self.name}: rss {memory['rss'] / 2 ** 20:0.0f} MB ({delta / 2 ** 20:+0.0f} MB)")
+                self._memory_start = None
 
         return elapsed_time
 
+    def _recreate_cm(self):
+        """Use a fresh timer for each call of a decorated function, so it can run in several threads"""
+        return replace(self)
+
     def __enter__(self):
         """Start a new timer as a context manager"""
         self.start()
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/18 10:02
+# @Last Modified by: wqshen
+
+
+import os
+import threading
+import numpy as np
+from datetime import timedelta
+from queue import Queue
+from logzero import logger
+from timer import Timer
+from packing import pack, pack_into, scale_offset, float16_packable, FILL_VALUE, VALID_RANGE
+
+try:
+    # the lock xarray takes around its HDF5 calls, so that files written by xarray and by netCDF4 or
+    # read by h5py in other threads never call the HDF5 library, which is not thread-safe, at once
+    from xarray.backends.locks import HDF5_LOCK
+except ImportError:
+    HDF5_LOCK = threading.Lock()
+
+
+# netcdf and zarr write a file per lead time, zarr-run writes a single store per initial time
+OUTPUT_FORMATS = ('netcdf', 'zarr', 'zarr-run')
+COMPRESSIONS = ('none', 'zlib', 'lz4', 'zstd')
+# chunk of a (time, level, lat, lon) variable, surface variables drop the level
+CHUNKS = (1, 1, 361, 720)
+# smaller spatial tiles of the run store, a point time series reads one tile per lead time
+RUN_STORE_CHUNKS = (1, 1, 181, 360)
+
+LEVELS = np.array([1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50])
+ATTRS = {'gh': {'long_name': 'Geopotential height', 'units': 'gpm'},
+         'q': {'long_name': 'Specific humidity', 'units': 'kg kg**-1'},
+         't': {'long_name': 'Temperature', 'units': 'K'},
+         'u': {'long_name': 'U component of wind', 'units': 'm s**-1'},
+         'v': {'long_name': 'V component of wind', 'units': 'm s**-1'},
+         'msl': {'long_name': 'Mean sea level pressure', 'units': 'Pa'},
+         'u10': {'long_name': '10 metre U wind component', 'units': 'm s**-1'},
+         'v10': {'long_name': '10 metre V wind component', 'units': 'm s**-1m s**-1'},
+         't2m': {'long_name': '2 metre temperature', 'units': 'K'},
+         }
+COORD_ATTRS = {'level': {'long_name': 'pressure', 'units': 'hPa'},
+               'lat': {'long_name': 'latitude', 'units': 'degrees_north'},
+               'lon': {'long_name': 'longitude', 'units': 'degrees_east'}}
+
+
+def output_path(inittime, fh, output_dir, output_format='netcdf', region=None):
+    name = f'.{region.name}' if region is not None else ''
+    if output_format == 'zarr-run':
+        return f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}{name}.zarr'
+    time = inittime + timedelta(hours=fh)
+    suffix = {'netcdf': 'nc', 'zarr': 'zarr'}[output_format]
+    return f'{output_dir}/{inittime:%Y%m%d%H/pangu.I%Y%m%d%H}.{fh:03d}.F{time:%Y%m%d%H}{name}.{suffix}'
+
+
+def output_encoding(ds, output_format='netcdf', compression='none', complevel=1):
+    """Per variable encoding of a forecast dataset for the given output format and compression
+
+    Variables are stored in chunks of one level and a quarter of the globe, so that chunks
+    are compressed independently, in parallel by the writer threads.
+
+    Parameters
+    ----------
+    ds: xr.Dataset, forecast dataset to be written
+    output_format: str, netcdf, zarr or zarr-run
+    compression: str, none, zlib, lz4 or zstd
+    complevel: int, compression level
+
+    Returns
+    -------
+    (dict), encoding to be passed to `to_netcdf` or `to_zarr`
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}")
+
+    if output_format == 'netcdf':
+        if compression == 'none':
+            return {}
+        codec = netcdf_codec(compression, complevel)
+        return {v: {**codec, 'chunksizes': _chunks(ds[v].shape)} for v in ds.data_vars}
+
+    codec = zarr_codec(compression, complevel)
+    return {v: {**codec, 'chunks': _chunks(ds[v].shape)} for v in ds.data_vars}
+
+
+def netcdf_codec(compression='zlib', complevel=1):
+    """Compression arguments of a netCDF4 variable, empty without compression"""
+    if compression == 'none':
+        return {}
+    # lz4 and zstd require netcdf-c built with the corresponding filter plugins
+    codec = {'zlib': {'zlib': True, 'shuffle': True},
+             'lz4': {'compression': 'blosc_lz4', 'shuffle': True},
+             'zstd': {'compression': 'zstd', 'shuffle': True}}[compression]
+    return {**codec, 'complevel': complevel}
+
+
+def zarr_compressor(compression='none', complevel=1):
+    """numcodecs compressor of the zarr formats"""
+    import numcodecs
+
+    # the global threading of Blosc is left alone, it is not safe to change from several writer threads
+    if compression == 'none':
+        return None
+    elif compression == 'zlib':
+        return numcodecs.Zlib(level=complevel)
+    return numcodecs.Blosc(cname=compression, clevel=complevel, shuffle=numcodecs.Blosc.SHUFFLE)
+
+
+def zarr_codec(compression='none', complevel=1):
+    """Compressor encoding of a zarr variable written in the zarr v2 format
+
+    zarr 3 takes a list of `compressors`, zarr 2 a single `compressor`.
+    """
+    import zarr
+
+    compressor = zarr_compressor(compression, complevel)
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        return {'compressors': [compressor] if compressor is not None else []}
+    return {'compressor': compressor}
+
+
+def _chunks(shape, chunks=CHUNKS):
+    chunks = chunks if len(shape) == 4 else chunks[:1] + chunks[2:]
+    return tuple(min(c, n) for c, n in zip(chunks, shape))
+
+
+class RunStore:
+    """A single zarr store holding all lead times of a forecast run
+
+    The time dimension is declared for every lead time of the run, and each step writes its own
+    time index when it finishes. Chunks of unfinished lead times are not written and read as NaN,
+    the `completed` attribute lists finished lead times. Metadata are consolidated after each step
+    so that readers open the store with a single read.
+
+    Parameters
+    ----------
+    path: str, path of the zarr store
+    inittime: datetime, initial time of forecast
+    fhs: list of int, forecast hours of the run
+    compression: str, none, zlib, lz4 or zstd
+    complevel: int, compression level
+    chunks: tuple, chunk of (time, level, lat, lon) variables, surface variables drop the level
+    resume: bool, reopen an existing store of the same lead times and keep its completed lead times
+    packing: str, none, int16 or float16, see `packing.py`
+    region: regions.Region, optional, the region written instead of the globe
+    derived: iterable of str, derived variables stored alongside the forecast variables, see `derived.py`
+    """
+
+    def __init__(self, path, inittime, fhs, compression='none', complevel=1, chunks=RUN_STORE_CHUNKS,
+                 resume=False, packing='none', region=None, derived=()):
+        import zarr
+        from derived import ATTRS as DERIVED_ATTRS, UPPER_VARS
+
+        self.path = path
+        self.inittime = inittime
+        self.packing = packing
+        self.region = region
+        self.derived = list(derived)
+        self.fhs = sorted(fhs)
+        self._index = {fh: i for i, fh in enumerate(self.fhs)}
+        self._lock = threading.Lock()
+        self._completed = []
+
+        if resume and os.path.isdir(path):
+            try:
+                self._root = zarr.open_group(path, mode='r+')
+                same_fhs = [int(fh) for fh in self._root['step'][:]] == self.fhs and \
+                    all(name in self._root for name in self.derived)
+            except Exception as e:
+                logger.warning(f"failed to open {path}: {e}")
+                same_fhs = False
+            if same_fhs:
+                self._completed = list(self._root.attrs.get('completed', []))
+                logger.info(f"resume {path} with {len(self._completed)} completed lead times")
+                return
+            logger.info(f"{path} can not be resumed, it is rewritten")
+
+        try:
+            self._root = zarr.open_group(path, mode='w', zarr_format=2)
+        except TypeError:
+            self._root = zarr.open_group(path, mode='w')
+        compressor = zarr_compressor(compression, complevel)
+        nt = len(self.fhs)
+        time_units = f'hours since {inittime:%Y-%m-%d %H:%M:%S}'
+        lats = region.lats if region is not None else np.linspace(90, -90, 721)
+        lons = region.lons if region is not None else np.linspace(0, 359.75, 1440)
+        coords = {'time': (np.array(self.fhs, dtype='i8'), ('time',),
+                           {'standard_name': 'time', 'units': time_units, 'calendar': 'proleptic_gregorian'}),
+                  'step': (np.array(self.fhs, dtype='i8'), ('time',), {'long_name': 'lead time', 'units': 'hours'}),
+                  'level': (LEVELS, ('level',), COORD_ATTRS['level']),
+                  'lat': (lats, ('lat',), COORD_ATTRS['lat']),
+                  'lon': (lons, ('lon',), COORD_ATTRS['lon'])}
+        for name, (data, dims, attrs) in coords.items():
+            arr = self._root.create_dataset(name, data=data, shape=data.shape, chunks=data.shape,
+                                            dtype=data.dtype, compressor=None)
+            arr.attrs.update({'_ARRAY_DIMENSIONS': list(dims), **attrs})
+        variables = {**ATTRS, **{name: DERIVED_ATTRS[name] for name in self.derived}}
+        for name, attrs in variables.items():
+            dims = ('time', 'level', 'lat', 'lon') if name in ('gh', 'q', 't', 'u', 'v', *UPPER_VARS) \
+                else ('time', 'lat', 'lon')
+            shape = (nt, len(LEVELS), len(lats), len(lons)) if len(dims) == 4 else (nt, len(lats), len(lons))
+            dtype, fill_value, packed_attrs = 'f4', np.nan, {}
+            if packing == 'int16' and name in VALID_RANGE:
+                scale, offset = scale_offset(name)
+                dtype, fill_value, packed_attrs = 'i2', FILL_VALUE, {'scale_factor': scale, 'add_offset': offset}
+            elif packing == 'float16' and name in VALID_RANGE and float16_packable(name):
+                dtype = 'f2'
+            arr = self._root.create_dataset(name, shape=shape, chunks=_chunks(shape, chunks), dtype=dtype,
+                                            compressor=compressor, fill_value=fill_value)
+            arr.attrs.update({'_ARRAY_DIMENSIONS': list(dims), 'coordinates': 'step', **attrs, **packed_attrs})
+        self._root.attrs['completed'] = []
+        zarr.consolidate_metadata(self._root.store)
+
+    @property
+    def completed(self):
+        """Lead times which have been written completely"""
+        return sorted(self._completed)
+
+    def write(self, inittime, fh, output, output_surface, derived=None):
+        """Write the output of `fh` and its `derived` fields ({name: array}) into its time index of the store"""
+        import zarr
+
+        i = self._index[fh]
+        if self.region is not None:
+            output, output_surface = self.region.subset(output), self.region.subset(output_surface)
+        z, q, t, u, v = output
+        mslp, u10, v10, t2m = output_surface
+        fields = dict(zip(ATTRS, (z / 9.80665, q, t, u, v, mslp, u10, v10, t2m)))
+        for name, d in (derived or {}).items():
+            if name in self.derived:
+                # derived fields are computed on the globe or on the region of the store
+                fields[name] = self.region.subset(d) if self.region is not None and d.shape[-2:] == (721, 1440) else d
+        for name, d in fields.items():
+            self._root[name][i] = pack(d, name, self.packing) if self.packing != 'none' else d
+        with self._lock:
+            self._completed.append(fh)
+            self._root.attrs['completed'] = sorted(self._completed)
+            zarr.consolidate_metadata(self._root.store)
+
+
+class NetCDFWriter:
+    """Write the NetCDF file of each lead time from a template built once per run
+
+    Coordinates, variable definitions, attributes and encodings are prepared when the writer is
+    created, so writing a lead time only creates the file and copies the arrays into its variables
+    with netCDF4. Geopotential height and packed integers are computed into per-thread scratch
+    buffers, netCDF4 calls hold `HDF5_LOCK` so several writer threads can share the writer.
+    Files have the same layout as the ones written by `pangu.write` through xarray.
+
+    Parameters
+    ----------
+    output_dir: str, directory of the outputs
+    compression: str, none, zlib, lz4 or zstd
+    complevel: int, compression level
+    packing: str, none or int16, see `packing.py`
+    region: regions.Region, optional, the region written instead of the globe
+    derived: iterable of str, derived variables written alongside the forecast variables, see `derived.py`
+    """
+
+    def __init__(self, output_dir, compression='none', complevel=1, packing='none', region=None, derived=()):
+        from derived import ATTRS as DERIVED_ATTRS, UPPER_VARS
+
+        if packing == 'float16':
+            raise ValueError("netcdf has no float16 type, use int16 packing or a zarr format")
+        self.output_dir = output_dir
+        self.packing = packing
+        self.region = region
+        self.lats = region.lats if region is not None else np.linspace(90, -90, 721)
+        self.lons = region.lons if region is not None else np.linspace(0, 359.75, 1440)
+        self.derived = list(derived)
+        codec = netcdf_codec(compression, complevel)
+        self.variables = []
+        for name, attrs in {**ATTRS, **{n: DERIVED_ATTRS[n] for n in self.derived}}.items():
+            upper = name in ('gh', 'q', 't', 'u', 'v', *UPPER_VARS)
+            dims = ('time', 'level', 'lat', 'lon') if upper else ('time', 'lat', 'lon')
+            shape = (1, len(LEVELS), len(self.lats), len(self.lons)) if upper else (1, len(self.lats), len(self.lons))
+            kwargs = {**codec, 'chunksizes': _chunks(shape)} if codec else {}
+            if packing == 'int16' and name in VALID_RANGE:
+                scale, offset = scale_offset(name)
+                dtype, fill_value, attrs = 'i2', FILL_VALUE, {**attrs, 'scale_factor': scale, 'add_offset': offset}
+            else:
+                dtype, fill_value = 'f4', np.float32(np.nan)
+            self.variables.append((name, dims, dtype, fill_value, attrs, kwargs))
+        self._scratch = threading.local()
+
+    def _buffers(self):
+        """Scratch float32 and int16 arrays of the size of an upper-air variable, one pair per thread"""
+        if not hasattr(self._scratch, 'f4'):
+            shape = (len(LEVELS), len(self.lats), len(self.lons))
+            self._scratch.f4 = np.empty(shape, dtype='f4')
+            self._scratch.i2 = np.empty(shape, dtype='i2') if self.packing == 'int16' else None
+        return self._scratch.f4, self._scratch.i2
+
+    def _create(self, path, time):
+        import netCDF4
+
+        nc = netCDF4.Dataset(path, 'w', format='NETCDF4')
+        nc.createDimension('time', 1)
+        nc.createDimension('level', len(LEVELS))
+        nc.createDimension('lat', len(self.lats))
+        nc.createDimension('lon', len(self.lons))
+        # encoded like xarray encodes a single datetime
+        v = nc.createVariable('time', 'i8', ('time',))
+        v.setncatts({'units': f'days since {time:%Y-%m-%d %H:%M:%S}', 'calendar': 'proleptic_gregorian'})
+        v[:] = 0
+        v = nc.createVariable('level', 'i8', ('level',))
+        v.setncatts(COORD_ATTRS['level'])
+        v[:] = LEVELS
+        for name, data in (('lat', self.lats), ('lon', self.lons)):
+            v = nc.createVariable(name, 'f8', (name,), fill_value=np.nan)
+            v.setncatts(COORD_ATTRS[name])
+            v[:] = data
+        for name, dims, dtype, fill_value, attrs, kwargs in self.variables:
+            v = nc.createVariable(name, dtype, dims, fill_value=fill_value, **kwargs)
+            v.setncatts(attrs)
+            v.set_auto_maskandscale(False)
+        return nc
+
+    @Timer(name='write_netcdf4', logger=logger.info)
+    def write(self, inittime, fh, output, output_surface, derived=None):
+        """Write the output of `fh` and its `derived` fields ({name: array}) into its file"""
+        time = inittime + timedelta(hours=fh)
+        if self.region is not None:
+            output, output_surface = self.region.subset(output), self.region.subset(output_surface)
+        fields = dict(zip(ATTRS, (*output, *output_surface)))
+        for name, d in (derived or {}).items():
+            if name in self.derived:
+                # derived fields are computed on the globe or on the region of the file
+                fields[name] = self.region.subset(d) if self.region is not None and d.shape[-2:] == (721, 1440) else d
+        f4, i2 = self._buffers()
+        os.makedirs(f'{self.output_dir}/{inittime:%Y%m%d%H}', exist_ok=True)
+        path = output_path(inittime, fh, self.output_dir, 'netcdf', self.region)
+        # written to a temporary path and renamed, so that a file under the final name is always complete
+        path_tmp = f'{path}.part'
+        # HDF5 calls are serialized, conversions into the scratch buffers run in parallel
+        with HDF5_LOCK:
+            nc = self._create(path_tmp, time)
+        try:
+            for name, *_ in self.variables:
+                if name not in fields:
+                    continue
+                d = fields[name]
+                if name == 'gh':
+                    d = np.divide(d, 9.80665, out=f4[:d.shape[0]])
+                if self.packing == 'int16' and name in VALID_RANGE:
+                    d = pack_into(d, name, f4[:d.shape[0]] if d.ndim == 3 else f4[0],
+                                  i2[:d.shape[0]] if d.ndim == 3 else i2[0])
+                with HDF5_LOCK:
+                    nc[name][0] = d
+        finally:
+            with HDF5_LOCK:
+                nc.close()
+        os.replace(path_tmp, path)
+
+
+class WriterError(Exception):
+    """Raised when some forecast outputs failed to be written by AsyncWriter"""
+
+
+class AsyncWriter:
+    """Write forecast outputs in background threads while the model keeps running
+
+    Items of (inittime, fh, output, output_surface) are put into a bounded queue and consumed
+    by `workers` threads calling `write_func(inittime, fh, output, output_surface, *args)`,
+    with `derived=` the derived fields of the output when they are given. The `Timer.labelled`
+    labels of the submitting thread are applied to the timers of its write.
+    `submit` blocks (backpressure) when the queue is full or the pending outputs exceed `max_bytes`.
+
+    Examples
+    --------
+        >>>writer = AsyncWriter(write, args=(output_dir,))
+        >>>writer.submit(inittime, fh, output, output_surface)
+        >>>writer.close()  # flush pending outputs and raise WriterError if any failed
+    """
+
+    def __init__(self, write_func, args=(), max_queue=4, max_bytes=None, workers=1):
+        self.write_func = write_func
+        self.args = args
+        self.max_bytes = max_bytes
+        self.errors = []
+        self._queue = Queue(maxsize=max_queue)
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._pending_bytes = 0
+        self._threads = [threading.Thread(target=self._work, name=f'pangu-writer-{i}', daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, inittime, fh, output, output_surface, derived=None):
+        """Queue an output and its derived fields ({name: array}) to be written, block while the writer is saturated
+
+        Raise WriterError if an output has failed already
+        """
+        if not self._threads:
+            raise WriterError("writer has been closed")
+        # fail fast, not after every step has run
+        self._raise_errors()
+        nbytes = output.nbytes + output_surface.nbytes + sum(d.nbytes for d in (derived or {}).values())
+        with self._cond:
+            while (self.max_bytes is not None and self._pending
+                   and self._pending_bytes + nbytes > self.max_bytes):
+                logger.debug(f"writer backpressure, {self._pending_bytes / 2 ** 20:.0f} MB pending")
+                self._cond.wait()
+            self._pending[fh] = nbytes
+            self._pending_bytes += nbytes
+        self._queue.put((inittime, fh, output, output_surface, derived, Timer.current_labels()))
+
+    def wait(self, fh):
+        """Block until the output of `fh` has been written"""
+        with self._cond:
+            while fh in self._pending:
+                self._cond.wait()
+
+    def flush(self):
+        """Block until all queued outputs have been written"""
+        self._queue.join()
+
+    def close(self):
+        """Flush and stop the workers, raise WriterError if any output failed"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._raise_errors()
+
+    def _raise_errors(self):
+        if self.errors:
+            fhs = ', '.join(f'{fh:03d}' for fh, _ in self.errors)
+            raise WriterError(f"failed to write fh={fhs}") from self.errors[0][1]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                inittime, fh, output, output_surface, derived, labels = item
+                kwargs = {'derived': derived} if derived is not None else {}
+                try:
+                    with Timer.labelled(**labels):
+                        self.write_func(inittime, fh, output, output_surface, *self.args, **kwargs)
+                except Exception as e:
+                    logger.exception(e)
+                    self.errors.append((fh, e))
+                finally:
+                    with self._cond:
+                        self._pending_bytes -= self._pending.pop(fh)
+                        self._cond.notify_all()
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 9:00
+# @Last Modified by: wqshen
+
+
+import os
+import sys
+
+# modules of the package import each other as top-level modules, as when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pangu'))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 9:00
+# @Last Modified by: wqshen
+
+
+import pytest
+
+np = pytest.importorskip('numpy')
+eccodes = pytest.importorskip('eccodes')
+pytest.importorskip('cfgrib')
+
+from writer import LEVELS  # noqa: E402
+from grib import GribIndex, UPPER_NAMES, SURFACE_NAMES  # noqa: E402
+from d1d_to_pangu import read_cfgrib, read_eccodes  # noqa: E402
+
+
+def write_grib(path, resolution=10.0, seed=0):
+    """Small D1D-like GRIB file with all messages read by the converter"""
+    rng = np.random.default_rng(seed)
+    nj, ni = int(180 / resolution) + 1, int(360 / resolution)
+    fields = [(name, int(level)) for name in UPPER_NAMES for level in LEVELS] + \
+             [(name, None) for name in SURFACE_NAMES]
+    with open(path, 'wb') as f:
+        for name, level in fields:
+            gid = eccodes.codes_grib_new_from_samples('regular_ll_pl_grib1' if level is not None
+                                                      else 'regular_ll_sfc_grib1')
+            try:
+                for key, value in (('Ni', ni), ('Nj', nj),
+                                   ('latitudeOfFirstGridPointInDegrees', 90.),
+                                   ('longitudeOfFirstGridPointInDegrees', 0.),
+                                   ('latitudeOfLastGridPointInDegrees', -90.),
+                                   ('longitudeOfLastGridPointInDegrees', 360. - resolution),
+                                   ('iDirectionIncrementInDegrees', resolution),
+                                   ('jDirectionIncrementInDegrees', resolution),
+                                   ('shortName', name), ('bitsPerValue', 16)):
+                    eccodes.codes_set(gid, key, value)
+                if level is not None:
+                    eccodes.codes_set(gid, 'level', level)
+                eccodes.codes_set_values(gid, rng.uniform(200, 300, nj * ni))
+                eccodes.codes_write(gid, f)
+            finally:
+                eccodes.codes_release(gid)
+
+
+def test_index_offsets_are_integers(tmp_path):
+    path = str(tmp_path / 'd1d.grib')
+    write_grib(path)
+    index = GribIndex.load(path)
+    assert all(isinstance(m[k], int) for m in index.messages for k in ('offset', 'totalLength', 'level'))
+    # the cached index is read back
+    assert GribIndex.load(path).messages == index.messages
+
+
+def test_eccodes_matches_cfgrib(tmp_path):
+    path = str(tmp_path / 'd1d.grib')
+    write_grib(path)
+    fields, lats, lons = read_eccodes(path, workers=2)
+    ds_surface, ds_upper = read_cfgrib(path)
+    np.testing.assert_allclose(lats, ds_upper['latitude'].values)
+    np.testing.assert_allclose(lons, ds_upper['longitude'].values)
+    upper = fields[:len(UPPER_NAMES) * len(LEVELS)].reshape((len(UPPER_NAMES), len(LEVELS)) + fields.shape[1:])
+    for name, d in zip(('z', 'q', 't', 'u', 'v'), upper):
+        np.testing.assert_allclose(d, ds_upper[name].values, rtol=1e-6)
+    for name, d in zip(('msl', 'u10', 'v10', 't2m', 'u100', 'v100'), fields[len(upper) * len(LEVELS):]):
+        np.testing.assert_allclose(d, ds_surface[name].values, rtol=1e-6)
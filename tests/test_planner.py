@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 14:40
+# @Last Modified by: wqshen
+
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from planner import plan_forecast, default_lead_times  # noqa: E402
+from pangu import StateStore, MAX_STATES  # noqa: E402
+
+
+@pytest.mark.parametrize('order', ['by-model', 'depth-first'])
+def test_state_usage_matches_state_store(order):
+    plan = plan_forecast(default_lead_times(), order=order)
+    for max_states in (None, 1, MAX_STATES):
+        peak, evicted = plan.state_usage(max_states)
+        assert peak == StateStore.peak(plan.schedule, max_states)
+        if max_states is None:
+            assert evicted == 0
+
+
+def test_describe_reports_evicted_states():
+    plan = plan_forecast(default_lead_times())
+    assert plan.state_usage(MAX_STATES)[1] > 0
+    assert 'read back from their outputs' in plan.describe(max_states=MAX_STATES, spill=False)
+    assert plan_forecast(default_lead_times(), order='depth-first').state_usage(MAX_STATES)[1] == 0
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 9:20
+# @Last Modified by: wqshen
+
+
+import json
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from reader import write_raw, read_raw, RAW_META  # noqa: E402
+
+
+def test_raw_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    upper = rng.standard_normal((5, 13, 721, 1440), dtype='f4')
+    surface = rng.standard_normal((4, 721, 1440), dtype='f4')
+    write_raw(str(tmp_path), upper, surface, inittime='2023100300', source='d1d.bz2')
+    with open(tmp_path / RAW_META) as f:
+        assert json.load(f)['inittime'] == '2023100300'
+    raw_upper, raw_surface = read_raw(str(tmp_path))
+    assert isinstance(raw_upper, np.memmap) and not raw_upper.flags.writeable
+    np.testing.assert_array_equal(raw_upper, upper)
+    np.testing.assert_array_equal(raw_surface, surface)
+
+
+def test_raw_missing_sidecar(tmp_path):
+    assert read_raw(str(tmp_path)) is None
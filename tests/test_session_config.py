@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 15:00
+# @Last Modified by: wqshen
+
+
+import glob
+import pytest
+
+np = pytest.importorskip('numpy')
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from onnx import helper, TensorProto  # noqa: E402
+from session_config import SessionConfig, create_session  # noqa: E402
+
+
+def make_model(path):
+    graph = helper.make_graph(
+        [helper.make_node('Mul', ['input', 'scale'], ['output'])], 'mul',
+        [helper.make_tensor_value_info('input', TensorProto.FLOAT, [2, 3])],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, [2, 3])],
+        [helper.make_tensor('scale', TensorProto.FLOAT, [], [2.0])])
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=7), path)
+
+
+def test_cached_model_shared_by_thread_options(tmp_path):
+    path = str(tmp_path / 'model.onnx')
+    make_model(path)
+    cache_dir = str(tmp_path / 'cache')
+    x = np.arange(6, dtype='f4').reshape(2, 3)
+    for threads in (1, 2):
+        config = SessionConfig.cpu(intra_op_num_threads=threads)
+        session = create_session(path, config, cache_dir)
+        np.testing.assert_array_equal(session.run(None, {'input': x})[0], 2 * x)
+    # 'all' and 'extended' share the graph serialized at 'extended'
+    create_session(path, SessionConfig.cpu(graph_optimization_level='extended'), cache_dir)
+    assert len(glob.glob(f'{cache_dir}/*.ort.onnx')) == 1
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 15:20
+# @Last Modified by: wqshen
+
+
+import os
+import threading
+
+from timer import _write_atomic
+
+
+def test_write_atomic_concurrent(tmp_path):
+    path = str(tmp_path / 'pangu.prom')
+    errors = []
+
+    def write(i):
+        for _ in range(100):
+            try:
+                _write_atomic(path, f'{i}\n' * 1000)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert os.listdir(tmp_path) == ['pangu.prom']
+    with open(path) as f:
+        assert len(set(f.read().split())) == 1
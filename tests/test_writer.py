@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# @Author: wqshen
+# @Email: wqshen91@gmail.com
+# @Date: 2026/10/19 14:10
+# @Last Modified by: wqshen
+
+
+import pytest
+from datetime import datetime
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('xarray')
+pytest.importorskip('zarr')
+pytest.importorskip('numcodecs')
+
+from regions import Region  # noqa: E402
+from pangu import write, open_output  # noqa: E402
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'lz4', 'zstd'])
+def test_zarr_round_trip(tmp_path, compression):
+    rng = np.random.default_rng(0)
+    output = rng.standard_normal((5, 13, 721, 1440), dtype='f4')
+    output_surface = rng.standard_normal((4, 721, 1440), dtype='f4')
+    region = Region('box', 100, 110, 20, 30)
+    inittime = datetime(2023, 10, 1, 0)
+    write(inittime, 6, output, output_surface, str(tmp_path), 'zarr', compression, region=region)
+    with open_output(inittime, 6, str(tmp_path), 'zarr', region) as ds:
+        np.testing.assert_array_equal(ds['t'].values[0], region.subset(output[2]))
+        np.testing.assert_array_equal(ds['t2m'].values[0], region.subset(output_surface[3]))
+        np.testing.assert_allclose(ds['gh'].values[0], region.subset(output[0]) / 9.80665, rtol=1e-6)
+        assert ds['t'].encoding['chunks'][-2:] == ds['t'].shape[-2:]